@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+"""
+    Benchmarks collect_metrics end to end against a fake HAProxy stats socket serving generated 'show info',
+    'show stat' and 'show resolvers' output, with collectd stubbed out by a stub that counts dispatched values.
+
+    Each scenario runs in a process of its own, so its CPU time and peak RSS are the plugin's alone, while the
+    fake socket is served by yet another process:
+
+        python benchmark.py
+        python benchmark.py --rows 1000 10000 --writer fragmented --transport tcp --option PipelineCommands=true
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import shutil
+import socket
+import sys
+import tempfile
+import time
+import types
+
+
+STAT_COLUMNS = [
+    'pxname', 'svname', 'qcur', 'qmax', 'scur', 'smax', 'slim', 'stot', 'bin', 'bout', 'dreq', 'dresp', 'ereq',
+    'econ', 'eresp', 'wretr', 'wredis', 'status', 'weight', 'act', 'bck', 'chkfail', 'chkdown', 'lastchg',
+    'downtime', 'qlimit', 'pid', 'iid', 'sid', 'throttle', 'lbtot', 'tracked', 'type', 'rate', 'rate_lim',
+    'rate_max', 'check_status', 'check_code', 'check_duration', 'hrsp_1xx', 'hrsp_2xx', 'hrsp_3xx', 'hrsp_4xx',
+    'hrsp_5xx', 'hrsp_other', 'hanafail', 'req_rate', 'req_rate_max', 'req_tot', 'cli_abrt', 'srv_abrt', 'comp_in',
+    'comp_out', 'comp_byp', 'comp_rsp', 'lastsess', 'last_chk', 'last_agt', 'qtime', 'ctime', 'rtime', 'ttime',
+    'agent_status', 'agent_code', 'agent_duration', 'check_desc', 'agent_desc', 'check_rise', 'check_fall',
+    'check_health', 'agent_rise', 'agent_fall', 'agent_health', 'addr', 'cookie', 'mode', 'algo', 'conn_rate',
+    'conn_rate_max', 'conn_tot', 'intercepted', 'dcon', 'dses'
+]
+
+TEXT_COLUMNS = {
+    'status': 'UP', 'check_status': 'L4OK', 'last_chk': '', 'last_agt': '', 'agent_status': '', 'check_desc': '',
+    'agent_desc': '', 'addr': '10.0.0.1:80', 'cookie': '', 'mode': 'http', 'algo': 'roundrobin', 'tracked': ''
+}
+
+INFO_FIELDS = [
+    'Nbproc', 'Process_num', 'Pid', 'Uptime_sec', 'Memmax_MB', 'Ulimit-n', 'Maxsock', 'Maxconn', 'Hard_maxconn',
+    'CurrConns', 'CumConns', 'CumReq', 'MaxSslConns', 'CurrSslConns', 'CumSslConns', 'Maxpipes', 'PipesUsed',
+    'PipesFree', 'ConnRate', 'ConnRateLimit', 'MaxConnRate', 'SessRate', 'SessRateLimit', 'MaxSessRate', 'SslRate',
+    'SslRateLimit', 'MaxSslRate', 'SslFrontendKeyRate', 'SslFrontendMaxKeyRate', 'SslFrontendSessionReuse_pct',
+    'SslBackendKeyRate', 'SslBackendMaxKeyRate', 'SslCacheLookups', 'SslCacheMisses', 'CompressBpsIn',
+    'CompressBpsOut', 'CompressBpsRateLim', 'ZlibMemUsage', 'MaxZlibMemUsage', 'Tasks', 'Run_queue', 'Idle_pct'
+]
+
+# each group of rows is a frontend, a backend and the backend's servers
+SERVERS_PER_BACKEND = 8
+
+# (bytes per write, seconds between writes) of each writer, None to write each response whole
+WRITERS = {
+    'fast': None,
+    'slow': (16 * 1024, 0.002),
+    'fragmented': (97, 0),
+}
+
+
+class ConfigNode(object):
+    def __init__(self, key, values):
+        self.key = key
+        self.values = values
+
+
+class ModuleConfig(object):
+    def __init__(self, children):
+        self.children = children
+
+
+class CountingValues(object):
+    """
+        Stands in for collectd.Values, counting dispatched values instead of sending them anywhere
+    """
+    dispatched = 0
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+    def dispatch(self, **kwargs):
+        CountingValues.dispatched += 1
+
+
+def install_collectd_stub():
+    collectd = types.ModuleType('collectd')
+    collectd.Values = CountingValues
+    for name in ('register_config', 'register_read', 'register_shutdown', 'register_init'):
+        setattr(collectd, name, lambda *args, **kwargs: None)
+    for name in ('debug', 'info', 'notice', 'warning', 'error'):
+        setattr(collectd, name, lambda message: None)
+    sys.modules['collectd'] = collectd
+
+
+class CountingSocket(object):
+    """
+        Wraps the sockets the plugin opens, counting the socket calls it makes
+    """
+    calls = 0
+
+    def __init__(self, *args):
+        self._sock = _real_socket(*args)
+
+    def __getattr__(self, name):
+        CountingSocket.calls += 1
+        return getattr(self._sock, name)
+
+
+_real_socket = socket.socket
+
+
+def generate_outputs(rows):
+    """
+        Returns the responses of a HAProxy with about rows frontend, backend and server rows
+    """
+    info = 'Name: HAProxy\nVersion: 1.8.14\nRelease_date: 2018/09/20\n'
+    info += ''.join('%s: %d\n' % (name, i) for i, name in enumerate(INFO_FIELDS))
+
+    lines = ['# ' + ','.join(STAT_COLUMNS) + ',']
+    group = 0
+    while len(lines) - 1 < rows:
+        proxy = 'px%d' % group
+        rows_of_group = [('FRONTEND', 0)] + [('srv%d' % i, 2) for i in range(SERVERS_PER_BACKEND)] + [('BACKEND', 1)]
+        for svname, proxy_type in rows_of_group[:rows - len(lines) + 1]:
+            values = []
+            for i, column in enumerate(STAT_COLUMNS):
+                if column == 'pxname':
+                    values.append(proxy)
+                elif column == 'svname':
+                    values.append(svname)
+                elif column == 'type':
+                    values.append(str(proxy_type))
+                elif column in TEXT_COLUMNS:
+                    values.append(TEXT_COLUMNS[column])
+                else:
+                    values.append(str((group * 31 + i * 7) % 10000))
+            lines.append(','.join(values) + ',')
+        group += 1
+    stat = '\n'.join(lines) + '\n'
+
+    resolvers = ''
+    for i in range(2):
+        resolvers += 'Resolvers section dns%d\n nameserver ns%d:\n' % (i, i)
+        resolvers += ''.join('  %s: %d\n' % (name, n) for n, name in enumerate(
+            ['sent', 'snd_error', 'valid', 'update', 'cname', 'cname_error', 'any_err', 'nx', 'timeout', 'refused',
+             'other', 'invalid', 'too_big', 'truncated', 'outdated']))
+    return {'show info': info, 'show stat': stat, 'show resolvers': resolvers}
+
+
+def _respond(outputs, command):
+    if command == 'prompt':
+        return ''
+    if command.startswith('show stat'):
+        # filters and typed output are left to the plugin to fall back from
+        return outputs['show stat'] if 'typed' not in command else 'Unknown command.\n'
+    if command.startswith('show info'):
+        return outputs['show info'] if 'typed' not in command else 'Unknown command.\n'
+    return outputs.get(command, 'Unknown command.\n')
+
+
+def _write(conn, data, writer):
+    if writer is None:
+        conn.sendall(data)
+        return
+    size, pause = writer
+    for start in range(0, len(data), size):
+        conn.sendall(data[start:start + size])
+        if pause:
+            time.sleep(pause)
+
+
+def _serve(listener, outputs, writer):
+    while True:
+        conn, _ = listener.accept()
+        try:
+            reader = conn.makefile('rb')
+            interactive = False
+            for line in iter(reader.readline, ''):
+                commands = line.rstrip('\n').split(';')
+                response = ''.join(_respond(outputs, command.strip()) + '\n' for command in commands)
+                if commands == ['prompt']:
+                    interactive = True
+                if interactive:
+                    response += '> '
+                _write(conn, response, writer)
+                if not interactive:
+                    conn.shutdown(socket.SHUT_RDWR)
+                    break
+        except socket.error:
+            pass
+        finally:
+            conn.close()
+
+
+def start_server(rows, writer, transport, directory):
+    """
+        Starts serving the outputs of generate_outputs(rows) in a process of its own.
+        Returns the process and the socket to configure the plugin with.
+    """
+    if transport == 'unix':
+        socket_file = os.path.join(directory, 'haproxy.sock')
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(socket_file)
+    else:
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        socket_file = '127.0.0.1:%d' % listener.getsockname()[1]
+    listener.listen(16)
+    server = multiprocessing.Process(target=_serve, args=(listener, generate_outputs(rows), WRITERS[writer]))
+    server.daemon = True
+    server.start()
+    listener.close()
+    return server, socket_file
+
+
+def run_scenario(socket_file, options, iterations, results):
+    install_collectd_stub()
+    socket.socket = CountingSocket
+    import haproxy
+
+    children = [ConfigNode('Socket', (socket_file,)), ConfigNode('EnhancedMetrics', ('true',)),
+                ConfigNode('ProxyMonitor', ('frontend', 'backend', 'server')), ConfigNode('Testing', ('true',))]
+    children += [ConfigNode(key, (value,)) for key, value in options]
+    module_config = haproxy.config(ModuleConfig(children))
+    # warm up caches, connections and the dispatch plan
+    haproxy.collect_metrics(module_config)
+
+    CountingValues.dispatched = 0
+    CountingSocket.calls = 0
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    started = time.time()
+    for _ in range(iterations):
+        haproxy.collect_metrics(module_config)
+    wall = time.time() - started
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    results.put({
+        'wall': wall / iterations,
+        'cpu': (after.ru_utime - usage.ru_utime + after.ru_stime - usage.ru_stime) / iterations,
+        'socket_calls': CountingSocket.calls / float(iterations),
+        'context_switches': (after.ru_nvcsw - usage.ru_nvcsw + after.ru_nivcsw - usage.ru_nivcsw) / float(iterations),
+        'peak_rss_kb': after.ru_maxrss,
+        'values': CountingValues.dispatched / iterations,
+        'values_per_second': CountingValues.dispatched / wall if wall else 0,
+    })
+
+
+def benchmark(rows, writer, transport, options, iterations):
+    directory = tempfile.mkdtemp()
+    server, socket_file = start_server(rows, writer, transport, directory)
+    try:
+        results = multiprocessing.Queue()
+        scenario = multiprocessing.Process(target=run_scenario, args=(socket_file, options, iterations, results))
+        scenario.start()
+        result = results.get()
+        scenario.join()
+        return result
+    finally:
+        server.terminate()
+        shutil.rmtree(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, nargs='+', default=[10, 1000, 10000, 50000],
+                        help='proxy and server rows of show stat to benchmark with')
+    parser.add_argument('--writer', choices=sorted(WRITERS) + ['all'], default='all',
+                        help='how the fake socket writes its responses')
+    parser.add_argument('--transport', choices=['unix', 'tcp'], default='unix')
+    parser.add_argument('--iterations', type=int, default=5, help='collections per scenario')
+    parser.add_argument('--option', action='append', default=[], metavar='KEY=VALUE',
+                        help='plugin configuration option, e.g. PersistentConnection=true')
+    args = parser.parse_args()
+    options = [option.split('=', 1) for option in args.option]
+    writers = sorted(WRITERS) if args.writer == 'all' else [args.writer]
+
+    print '%7s %-10s %10s %10s %12s %10s %12s %10s %12s' % (
+        'rows', 'writer', 'wall ms', 'cpu ms', 'socket calls', 'ctx sw', 'peak rss KB', 'values', 'values/s')
+    for rows in args.rows:
+        for writer in writers:
+            result = benchmark(rows, writer, args.transport, options, args.iterations)
+            print '%7d %-10s %10.2f %10.2f %12.0f %10.0f %12d %10d %12.0f' % (
+                rows, writer, result['wall'] * 1000, result['cpu'] * 1000, result['socket_calls'],
+                result['context_switches'], result['peak_rss_kb'], result['values'], result['values_per_second'])
+
+
+if __name__ == '__main__':
+    main()
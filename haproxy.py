@@ -8,15 +8,43 @@
 #
 # Modified by "Warren Turkal" <wt@signalfuse.com>, "Volodymyr Zhabiuk" <vzhabiuk@signalfx.com>
 
-import cStringIO as StringIO
 import socket
+import array
 import csv
+import fnmatch
+import hashlib
+import heapq
+import itertools
+import mmap
+import re
 import pprint
+import random
+import struct
+import threading
+import time
+import Queue
+from collections import OrderedDict
 
 import collectd
 
 PLUGIN_NAME = 'haproxy'
-RECV_SIZE = 1024
+# every datapoint is dispatched through this one collectd.Values, passing what tells them apart to dispatch()
+DISPATCH_VALUES = collectd.Values(plugin=PLUGIN_NAME)
+# header and record lengths of the files of CaptureWriter
+CAPTURE_MAGIC = 'HAPXCAP1'
+CAPTURE_RECORD = struct.Struct('!II')
+
+# reads start at RECV_SIZE bytes and double while they fill up, up to MAX_RECV_SIZE
+RECV_SIZE = 4096
+MAX_RECV_SIZE = 256 * 1024
+# In interactive ("prompt") mode HAProxy terminates every response with a prompt after the empty line ending it,
+# '> ' for a process CLI and 'master> ' for the master CLI
+PROMPT_PATTERN = re.compile(r'\n(?:master[^\n>]*)?> ')
+# the first line of 'show info typed' and 'show stat typed' output
+TYPED_OUTPUT_PATTERN = re.compile(r'(?:[FBLS]\.\d+\.\d+\.)?\d+\.\w+\.\d+:')
+TYPED_INTEGER_TYPES = frozenset(['s32', 's64', 'u32', 'u64'])
+# 'show stat typed' object types to the type column of 'show stat'
+TYPED_OBJECT_TYPES = {'F': '0', 'B': '1', 'S': '2', 'L': '3'}
 
 METRICS_TO_COLLECT = {
     'ConnRate': 'gauge', 'CumReq': 'derive', 'Idle_pct': 'gauge', 'scur': 'gauge', 'SessRate': 'gauge',
@@ -39,158 +67,2053 @@ METRICS_TO_COLLECT = {
     'other': 'gauge', 'invalid': 'gauge', 'too_big': 'gauge', 'truncated': 'gauge', 'outdated': 'gauge'
 }
 
-DEFAULT_SOCKET = '/var/run/haproxy.sock'
-DEFAULT_PROXY_MONITORS = ['server', 'frontend', 'backend']
+# Collected unless EnhancedMetrics is on, which adds the rest of METRICS_TO_COLLECT
+BASIC_METRICS = frozenset([
+    'ConnRate', 'CumReq', 'Idle_pct', 'SessRate', 'MaxConn', 'CumConns', 'Tasks', 'Run_queue', 'Uptime_sec',
+    'CurrConns', 'CurrSslConns', 'SslRate', 'scur', 'smax', 'slim', 'stot', 'bin', 'bout', 'rate', 'req_rate',
+    'hrsp_1xx', 'hrsp_2xx', 'hrsp_3xx', 'hrsp_4xx', 'hrsp_5xx', 'hrsp_other', 'ereq', 'econ', 'eresp', 'dreq', 'dresp',
+    'qcur', 'qmax', 'qtime', 'ctime', 'rtime', 'ttime', 'wretr', 'wredis', 'act', 'bck', 'chkfail', 'downtime',
+    'lbtot', 'cli_abrt', 'srv_abrt', 'sent', 'snd_error', 'valid', 'update', 'cname', 'cname_error', 'any_err', 'nx',
+    'timeout', 'refused', 'other', 'invalid', 'too_big', 'truncated', 'outdated'
+])
+
+# When AggregateProcesses merges the stats of several processes, these take the highest value across processes,
+# as they are maximums, averages, limits shared by all processes or the same servers seen by each. Everything
+# else is summed.
+AGGREGATE_WITH_MAX = frozenset([
+    'Idle_pct', 'Uptime_sec', 'MaxConn', 'MaxConnRate', 'MaxSessRate', 'MaxSslConns', 'MaxPipes', 'smax', 'qmax',
+    'rate_max', 'req_rate_max', 'conn_rate_max', 'rate_lim', 'qtime', 'ctime', 'rtime', 'ttime', 'check_duration',
+    'lastsess', 'downtime', 'throttle', 'act', 'bck'
+])
+
+# Gauges of the plugin's own work in the last collection, dispatched under the collector plugin instance with
+# SelfMetrics. Times are in seconds, summed over the sockets of the module.
+SELF_METRICS = (
+    'connect_time', 'io_time', 'requests', 'bytes_received', 'collect_time', 'parse_time', 'rows_seen',
+    'rows_filtered', 'values_dispatched', 'dispatch_time', 'errors'
+)
+
+# 'show table' lines describing a table, and the columns of 'show table <name>' entries aggregated by StickTableEntries
+TABLE_HEADER_PATTERN = re.compile(r'# table: (?P<table>[^,]+), type: (?P<type>[^,]+), size:(?P<size>\d+), '
+                                  r'used:(?P<used>\d+)')
+TABLE_COLUMN_PATTERN = re.compile(r'gpc\d+$|gpt\d+$|\w+_rate$')
+TABLE_SAMPLE_SIZE = 1024
+TABLE_QUANTILES = (50, 95, 99)
+# characters of stick table keys kept in the type instances of StickTableTopN, others being replaced by '_' as
+# file based writers such as rrdtool and csv name files after identifiers, and the length past which keys are
+# cut short and suffixed with a hash to fit collectd's 63 character type instances
+TABLE_KEY_UNSAFE_PATTERN = re.compile(r'[^A-Za-z0-9_.-]')
+TABLE_KEY_MAX_LENGTH = 40
+DEFAULT_TABLE_TOP_N = 10
+
+# Metrics of HAProxy's internals and their types, per source: the event loop counters of 'show activity', the
+# memory pools of 'show pools', the run queue of 'show tasks' and the sessions of 'show sess'
+ACTIVITY_METRICS = {
+    'loops': 'derive', 'wake_tasks': 'derive', 'wake_signal': 'derive', 'wake_cache': 'derive', 'poll_io': 'derive',
+    'poll_exp': 'derive', 'poll_drop': 'derive', 'poll_drop_fd': 'derive', 'poll_dead': 'derive',
+    'poll_dead_fd': 'derive', 'poll_skip': 'derive', 'poll_skip_fd': 'derive', 'fd_skip': 'derive',
+    'fd_lock': 'derive', 'fd_del': 'derive', 'conn_dead': 'derive', 'stream': 'derive', 'stream_calls': 'derive',
+    'ctxsw': 'derive', 'tasksw': 'derive', 'empty_rq': 'derive', 'long_rq': 'derive', 'pool_fail': 'derive',
+    'buf_wait': 'derive', 'accepted': 'derive', 'accq_pushed': 'derive', 'accq_full': 'derive',
+    'fd_takeover': 'derive', 'cpust_ms_tot': 'derive', 'avg_loop_us': 'gauge', 'cpust_ms_1s': 'gauge',
+    'cpust_ms_15s': 'gauge'
+}
+POOL_METRICS = OrderedDict([
+    ('allocated', 'gauge'), ('allocated_bytes', 'gauge'), ('used', 'gauge'), ('used_bytes', 'gauge'),
+    ('failures', 'derive')
+])
+TASK_METRICS = {'running': 'gauge', 'places': 'gauge'}
+SESSION_METRICS = {'sessions': 'gauge'}
+INTERNAL_METRIC_TYPES = {
+    'activity': ACTIVITY_METRICS, 'pool': POOL_METRICS, 'tasks': TASK_METRICS, 'sessions': SESSION_METRICS
+}
+POOL_PATTERN = re.compile(r'- Pool (?P<pool>\S+) \((?P<size>\d+) bytes\) : (?P<allocated>\d+) allocated '
+                          r'\((?P<allocated_bytes>\d+) bytes\), (?P<used>\d+) used,.*?(?P<failures>\d+) failures')
+POOL_TOTAL_PATTERN = re.compile(r'Total: \d+ pools, (?P<allocated_bytes>\d+) bytes allocated, (?P<used_bytes>\d+) used')
+TASKS_RUNNING_PATTERN = re.compile(r'Running tasks: (\d+)')
+SESSION_FRONTEND_PATTERN = re.compile(r' fe=(\S+)')
+
+# Multi-value data sets of haproxy_types.db dispatching related metrics of a row together with GroupMetrics,
+# along with the metrics making them up, in the order of their data sources
+GROUPED_METRICS = OrderedDict([
+    ('haproxy_bytes', ('bin', 'bout')),
+    ('haproxy_responses', ('hrsp_1xx', 'hrsp_2xx', 'hrsp_3xx', 'hrsp_4xx', 'hrsp_5xx', 'hrsp_other')),
+    ('haproxy_errors', ('ereq', 'econ', 'eresp')),
+    ('haproxy_denied', ('dreq', 'dresp')),
+    ('haproxy_warnings', ('wretr', 'wredis')),
+    ('haproxy_aborts', ('cli_abrt', 'srv_abrt')),
+    ('haproxy_compression', ('comp_in', 'comp_out', 'comp_byp', 'comp_rsp')),
+    ('haproxy_sessions', ('scur', 'smax')),
+    ('haproxy_queue', ('qcur', 'qmax')),
+    ('haproxy_timings', ('qtime', 'ctime', 'rtime', 'ttime')),
+])
+GROUPED_METRIC_NAMES = frozenset(itertools.chain.from_iterable(GROUPED_METRICS.values()))
+
+# Statistics of the servers of a backend dispatched by AggregateServerMetric, along with p50 and p95 with
+# AggregateServerPercentiles
+SERVER_AGGREGATE_STATISTICS = ('sum', 'min', 'max', 'mean')
+
+DEFAULT_SOCKET = '/var/run/haproxy.sock'
+DEFAULT_MAX_WORKERS = 4
+DEFAULT_POLL_INTERVAL = 10
+DEFAULT_HEARTBEAT_INTERVALS = 10
+DEFAULT_BURST_SAMPLE_INTERVAL = 1
+DEFAULT_MAX_BACKOFF = 300
+DEFAULT_PROXY_MONITORS = ['server', 'frontend', 'backend']
+# 'show stat' type filter bits for each proxy monitor type, see should_capture_metric
+# for why servers come with backends
+PROXY_TYPE_FILTERS = {'frontend': 1, 'backend': 2 | 4, 'server': 4}
+
+
+class CollectionTimeout(socket.timeout):
+    """
+        Raised when the deadline of a collection passes between socket operations
+    """
+
+
+class ReceiveBuffer(object):
+    """
+        A growable buffer reused across responses, which socket reads land in directly
+    """
+
+    def __init__(self):
+        self.data = bytearray(RECV_SIZE * 16)
+        self.length = 0
+        self.recv_size = RECV_SIZE
+
+    def clear(self):
+        self.length = 0
+
+    def recv_from(self, stat_sock):
+        """
+            Reads once from the socket onto the end of the buffer. Returns the number of bytes read, 0 on EOF.
+        """
+        if len(self.data) - self.length < self.recv_size:
+            self.data.extend(bytearray(len(self.data)))
+        view = memoryview(self.data)[self.length:self.length + self.recv_size]
+        received = stat_sock.recv_into(view, self.recv_size)
+        self.length += received
+        # a full read means more is queued, so ask for more next time to cut down on syscalls
+        if received == self.recv_size and self.recv_size < MAX_RECV_SIZE:
+            self.recv_size *= 2
+        return received
+
+    def discard(self, count):
+        """
+            Drops the first count bytes, moving the rest to the start of the buffer
+        """
+        remaining = self.length - count
+        self.data[:remaining] = self.data[count:self.length]
+        self.length = remaining
+
+    def find(self, sub, start=0):
+        return self.data.find(sub, start, self.length)
+
+    def rfind(self, sub, start=0):
+        return self.data.rfind(sub, start, self.length)
+
+    def search(self, pattern, start=0):
+        return pattern.search(self.data, start, self.length)
+
+    def getvalue(self, start=0, end=None):
+        if end is None:
+            end = self.length
+        return memoryview(self.data)[start:end].tobytes()
+
+
+class CaptureWriter(object):
+    """
+        Records each request sent to the stats sockets and the raw response read back to a capture file, for a
+        CaptureReplay to answer with later. Each record is the lengths of both packed in CAPTURE_RECORD,
+        followed by the request and response bytes.
+    """
+
+    def __init__(self, path):
+        self._file = open(path, 'wb')
+        self._file.write(CAPTURE_MAGIC)
+        self._lock = threading.Lock()
+
+    def write(self, request, response):
+        with self._lock:
+            self._file.write(CAPTURE_RECORD.pack(len(request), len(response)))
+            self._file.write(request)
+            self._file.write(response)
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class RecordingSocket(object):
+    """
+        Wraps a stats socket, recording every request sent over it along with the bytes read until the next one
+    """
+
+    def __init__(self, stat_sock, capture):
+        self._sock = stat_sock
+        self._capture = capture
+        self._request = None
+        self._response = bytearray()
+
+    def settimeout(self, timeout):
+        self._sock.settimeout(timeout)
+
+    def sendall(self, data):
+        self._record()
+        self._request = data
+        self._sock.sendall(data)
+
+    def recv_into(self, buf, size):
+        received = self._sock.recv_into(buf, size)
+        self._response += buf[:received].tobytes()
+        return received
+
+    def close(self):
+        self._record()
+        self._sock.close()
+
+    def _record(self):
+        if self._request is not None:
+            self._capture.write(self._request, bytes(self._response))
+        self._request = None
+        self._response = bytearray()
+
+
+class CaptureReplay(object):
+    """
+        The responses of a capture file, answering requests in place of HAProxy. A request recorded several times
+        is answered with each of its responses in turn, starting over once they run out. With use_mmap the file
+        is memory mapped instead of read into memory.
+    """
+
+    def __init__(self, path, use_mmap=False):
+        with open(path, 'rb') as capture_file:
+            if use_mmap:
+                self.data = mmap.mmap(capture_file.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.data = capture_file.read()
+        if self.data[:len(CAPTURE_MAGIC)] != CAPTURE_MAGIC:
+            raise ValueError('%s is not a capture file' % path)
+        # request -> list of (offset, length) of its responses in data
+        self._responses = {}
+        self._next = {}
+        offset = len(CAPTURE_MAGIC)
+        while offset < len(self.data):
+            request_length, response_length = CAPTURE_RECORD.unpack_from(self.data, offset)
+            offset += CAPTURE_RECORD.size
+            request = self.data[offset:offset + request_length]
+            offset += request_length
+            self._responses.setdefault(request, []).append((offset, response_length))
+            offset += response_length
+        self._lock = threading.Lock()
+
+    def get_response(self, request):
+        """
+            Returns the offsets in data between which the next response to the request lies
+        """
+        with self._lock:
+            responses = self._responses.get(request)
+            if not responses:
+                collectd.warning('%s: No response to %r in capture' % (PLUGIN_NAME, request))
+                return 0, 0
+            i = self._next.get(request, 0)
+            self._next[request] = (i + 1) % len(responses)
+        offset, length = responses[i]
+        return offset, offset + length
+
+
+class ReplaySocket(object):
+    """
+        Stands in for a stats socket, serving the responses of a CaptureReplay
+    """
+
+    def __init__(self, replay):
+        self._replay = replay
+        self._position = self._end = 0
+
+    def settimeout(self, timeout):
+        pass
+
+    def sendall(self, data):
+        self._position, self._end = self._replay.get_response(data)
+
+    def recv_into(self, buf, size):
+        size = min(size, self._end - self._position)
+        buf[:size] = self._replay.data[self._position:self._position + size]
+        self._position += size
+        return size
+
+    def close(self):
+        pass
+
+
+class HAProxySocket(object):
+    """
+            Encapsulates communication with HAProxy via the socket interface
+    """
+
+    def __init__(self, socket_file=DEFAULT_SOCKET, persistent=False, master=False, typed=False, capture=None,
+                 replay=None):
+        self.socket_file = socket_file
+        # the master CLI only routes to workers within a session
+        self.persistent = persistent or master
+        self.master = master
+        # ask for 'typed' output of info and stats, until HAProxy turns out not to support it
+        self.typed = typed
+        self._session = None
+        self._buffer = ReceiveBuffer()
+        # time.time() by which the current collection has to be done, None to wait indefinitely
+        self.deadline = None
+        # I/O counters since the last drain_io_stats, see SelfMetrics
+        self.connect_time = 0.0
+        self.io_time = 0.0
+        self.requests = 0
+        self.bytes_received = 0
+        # name of the command last sent -> [seconds sending it and waiting on its response, times sent]
+        self.command_times = {}
+        self._command_time = None
+        # CaptureWriter recording the responses read, or CaptureReplay answering in place of HAProxy
+        self.capture = capture
+        self.replay = replay
+
+    def connect(self):
+        if self.replay is not None:
+            return ReplaySocket(self.replay)
+        stat_sock = self._connect()
+        if stat_sock is not None and self.capture is not None:
+            return RecordingSocket(stat_sock, self.capture)
+        return stat_sock
+
+    def _connect(self):
+        # unix sockets all start with '/', use tcp otherwise
+        is_unix = self.socket_file.startswith('/')
+        if is_unix:
+            stat_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            stat_sock.settimeout(self._get_timeout())
+            started = time.time()
+            stat_sock.connect(self.socket_file)
+            self.connect_time += time.time() - started
+            return stat_sock
+        else:
+            socket_host, separator, port = self.socket_file.rpartition(':')
+            if socket_host != '' and port != '' and separator == ':':
+                stat_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                stat_sock.settimeout(self._get_timeout())
+                started = time.time()
+                stat_sock.connect((socket_host, int(port)))
+                self.connect_time += time.time() - started
+                return stat_sock
+            else:
+                collectd.error('Could not connect to socket with host %s. Check HAProxy config.' % self.socket_file)
+                return
+
+    def communicate(self, command):
+        '''Get response from single command.
+
+        Args:
+            command: string command to send to haproxy stat socket
+
+        Returns:
+            a string of the response data
+        '''
+        if not command.endswith('\n'):
+            command += '\n'
+        if self.persistent:
+            return self._communicate_session(command)[0]
+        stat_sock = self.connect()
+        if stat_sock is None:
+            return ''
+        result_buf = self._buffer
+        result_buf.clear()
+        try:
+            self._send(stat_sock, command)
+            while self._recv(stat_sock):
+                pass
+        finally:
+            stat_sock.close()
+        return result_buf.getvalue()
+
+    def iter_lines(self, command):
+        '''Get response from single command, line by line as it is read off the socket.
+
+        Only the lines not yet consumed from the latest read are held in
+        memory, however long the response is.
+
+        Args:
+            command: string command to send to haproxy stat socket
+
+        Returns:
+            an iterator over the lines of the response data
+        '''
+        if not command.endswith('\n'):
+            command += '\n'
+        if self.persistent:
+            for line in self._iter_session_lines(command):
+                yield line
+            return
+        stat_sock = self.connect()
+        if stat_sock is None:
+            return
+        try:
+            self._send(stat_sock, command)
+            for line in self._read_lines(stat_sock):
+                yield line
+        finally:
+            stat_sock.close()
+
+    def communicate_batch(self, commands):
+        '''Get responses from several commands in a single round trip.
+
+        Outside of interactive mode the commands are joined with ';' on one
+        line. HAProxy then sends the responses back to back, each ending with
+        an empty line, so only the last command may produce empty lines of
+        its own (e.g. 'show resolvers').
+
+        Args:
+            commands: list of string commands to send to haproxy stat socket
+
+        Returns:
+            a list with the response string of each command
+        '''
+        commands = [command.rstrip('\n') for command in commands]
+        if self.persistent:
+            return self._communicate_session(''.join(command + '\n' for command in commands), len(commands))
+        return _split_batch_output(self.communicate(';'.join(commands)), len(commands))
+
+    def _get_timeout(self):
+        if self.deadline is None:
+            return None
+        remaining = self.deadline - time.time()
+        if remaining <= 0:
+            raise CollectionTimeout('Deadline passed talking to HAProxy socket at %s' % self.socket_file)
+        return remaining
+
+    def _send(self, stat_sock, data):
+        stat_sock.settimeout(self._get_timeout())
+        command_name = _get_command_name(data)
+        self._command_time = self.command_times.get(command_name)
+        if self._command_time is None:
+            self._command_time = self.command_times[command_name] = [0.0, 0]
+        started = time.time()
+        stat_sock.sendall(data)
+        elapsed = time.time() - started
+        self.io_time += elapsed
+        self._command_time[0] += elapsed
+        self._command_time[1] += 1
+        self.requests += 1
+
+    def _recv(self, stat_sock):
+        stat_sock.settimeout(self._get_timeout())
+        started = time.time()
+        received = self._buffer.recv_from(stat_sock)
+        elapsed = time.time() - started
+        self.io_time += elapsed
+        # responses are read after their command is sent and before the next one is
+        self._command_time[0] += elapsed
+        self.bytes_received += received
+        return received
+
+    def drain_io_stats(self):
+        """
+            Returns the I/O counters of the socket since the last call, resetting them
+        """
+        io_stats = {'connect_time': self.connect_time, 'io_time': self.io_time, 'requests': self.requests,
+                    'bytes_received': self.bytes_received, 'command_times': self.command_times}
+        self.connect_time = self.io_time = 0.0
+        self.requests = self.bytes_received = 0
+        self.command_times = {}
+        self._command_time = [0.0, 0]
+        return io_stats
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+    def _open_session(self):
+        stat_sock = self.connect()
+        if stat_sock is None:
+            return
+        try:
+            self._send(stat_sock, 'prompt\n')
+            # unlike a process, the master CLI sends no empty line before its first prompt
+            result_buf = self._buffer
+            result_buf.clear()
+            while result_buf.getvalue(max(result_buf.length - 2, 0)) != '> ':
+                if not self._recv(stat_sock):
+                    raise socket.error('HAProxy closed the stats session')
+        except socket.error:
+            stat_sock.close()
+            raise
+        self._session = stat_sock
+
+    def _communicate_session(self, command, count=1):
+        '''Send command lines over the interactive session, opening it if needed.
+
+        HAProxy drops CLI sessions on reload and after the stats timeout, so a
+        failure on an established session is retried once on a new connection.
+        Returns the responses to the count commands sent.
+        '''
+        for attempt in range(2):
+            if self._session is None:
+                self._open_session()
+                if self._session is None:
+                    return [''] * count
+            try:
+                self._send(self._session, command)
+                return self._read_until_prompt(self._session, count)
+            except socket.error:
+                self.close()
+                if attempt:
+                    raise
+
+    def _iter_session_lines(self, command):
+        for attempt in range(2):
+            if self._session is None:
+                self._open_session()
+                if self._session is None:
+                    return
+            lines = self._read_lines(self._session, until_prompt=True)
+            try:
+                self._send(self._session, command)
+                first_line = next(lines)
+            except socket.error:
+                self.close()
+                if attempt:
+                    raise
+                continue
+            # a response abandoned half way would be read as the next one, so drop the session instead
+            completed = False
+            try:
+                yield first_line
+                for line in lines:
+                    yield line
+                completed = True
+            finally:
+                if not completed:
+                    self.close()
+            return
+
+    def _read_lines(self, stat_sock, until_prompt=False):
+        result_buf = self._buffer
+        result_buf.clear()
+        line = None
+        while True:
+            if not self._recv(stat_sock):
+                if until_prompt:
+                    raise socket.error('HAProxy closed the stats session')
+                if result_buf.length:
+                    yield result_buf.getvalue()
+                return
+            start = 0
+            end = result_buf.find('\n')
+            while end != -1:
+                line = result_buf.getvalue(start, end)
+                yield line
+                start = end + 1
+                end = result_buf.find('\n', start)
+            result_buf.discard(start)
+            # the prompt follows the empty line ending the response, without a newline of its own
+            if until_prompt and line == '' and _is_prompt(result_buf.getvalue()):
+                return
+
+    def _read_until_prompt(self, stat_sock, count=1):
+        result_buf = self._buffer
+        result_buf.clear()
+        prompts = []
+        scanned = 0
+        while len(prompts) < count:
+            if not self._recv(stat_sock):
+                raise socket.error('HAProxy closed the stats session')
+            prompt = result_buf.search(PROMPT_PATTERN, scanned)
+            while prompt:
+                prompts.append(prompt)
+                scanned = prompt.end()
+                prompt = result_buf.search(PROMPT_PATTERN, scanned)
+            # a prompt still split across this read and the next one starts at the last newline
+            last_newline = result_buf.rfind('\n', scanned)
+            scanned = result_buf.length if last_newline == -1 else last_newline
+        # drop the prompts but keep the newline ending each response, so the
+        # results match what a non-interactive connection returns
+        responses = []
+        start = 0
+        for prompt in prompts:
+            responses.append(result_buf.getvalue(start, prompt.start() + 1))
+            start = prompt.end()
+        return responses
+
+    def get_tables(self):
+        '''Gets the stick tables from 'show table'
+
+        Returns:
+            a list of dicts of the name, type, size and number of used entries of each table
+        '''
+        return _parse_tables(self.communicate('show table'))
+
+    def iter_table_entries(self, table):
+        '''Streams the entries of a stick table, never holding more than the latest read of the dump
+
+        Returns:
+            an iterator over (key, list of (column, value)) pairs of the gpc and rate columns of each entry
+        '''
+        for line in self.iter_lines('show table %s' % table):
+            if line and not line.startswith('#'):
+                entry = _parse_table_entry(line)
+                if entry is not None:
+                    yield entry
+
+    def get_activity(self):
+        '''Gets the counters of the event loop from 'show activity'
+
+        Returns:
+            a dict of each counter of ACTIVITY_METRICS to its total, None if unknown, and its values per thread
+        '''
+        return _parse_activity(self.communicate('show activity'))
+
+    def get_pools(self):
+        '''Gets the memory pools from 'show pools'
+
+        Returns:
+            a tuple of a dict of each pool's name to its metrics of POOL_METRICS, and a dict of the totals
+            over all pools
+        '''
+        return _parse_pools(self.communicate('show pools'))
+
+    def get_tasks(self):
+        '''Gets the composition of the run queue from 'show tasks'
+
+        Returns:
+            a tuple of the number of running tasks, None if unknown, and a dict of each task function to the
+            number of tasks of it in the run queue
+        '''
+        return _parse_tasks(self.communicate('show tasks'))
+
+    def get_sessions_summary(self):
+        '''Counts the sessions of 'show sess', streaming them rather than holding every session's line
+
+        Returns:
+            a tuple of the number of sessions and a dict of each frontend to its number of sessions
+        '''
+        return _summarize_sessions(self.iter_lines('show sess'))
+
+    def get_resolvers(self):
+        ''' Gets the resolver config and returns a map of nameserver -> nameservermetrics
+        The output from the socket looks like
+        Resolvers section mydns
+         nameserver dns1:
+          sent:        8
+          ...
+
+        :return:
+        map of nameserver -> nameservermetrics
+        e.g. '{dns1': {'sent': '8', ...}, ...}
+        '''
+        return _parse_resolvers(self.communicate('show resolvers'))
+
+    def get_server_info(self):
+        if self.typed:
+            output = self.communicate('show info typed')
+            if self._check_typed(output):
+                return _parse_server_info(output)
+        return _parse_server_info(self.communicate('show info'))
+
+    def get_server_stats(self, proxy_types=-1):
+        '''Returns an iterator over the 'show stat' rows, reading them off the socket as it is consumed
+
+        Args:
+            proxy_types: bitmask of the proxy types HAProxy should return rows for, -1 for all
+        '''
+        if self.typed:
+            lines = self.iter_lines(_stat_command(proxy_types, typed=True))
+            first_line = next(lines, '')
+            if self._check_typed(first_line):
+                return _iter_typed_server_stats(itertools.chain([first_line], lines))
+            for _ in lines:
+                pass
+        return _iter_server_stats(self.iter_lines(_stat_command(proxy_types)))
+
+    def get_all_stats(self, proxy_types=-1):
+        '''Get server info, server stats and resolvers with a single command batch.
+
+        Returns:
+            a tuple of the results of get_server_info, get_server_stats and get_resolvers
+        '''
+        responses = self.communicate_batch(_get_stats_commands(proxy_types, self.typed))
+        if self.typed and not self._check_typed(responses[0]):
+            responses = self.communicate_batch(_get_stats_commands(proxy_types))
+        info, stat, resolvers = responses
+        return _parse_server_info(info), _parse_server_stats(stat), _parse_resolvers(resolvers)
+
+    def _check_typed(self, output):
+        '''Returns whether output can be read as typed, turning typed output off when it can't
+
+        HAProxy versions before 1.7 answer typed commands with their usage. An
+        empty reply, e.g. to a filter matching no rows or from a connection
+        closed on reload, holds no data either way and leaves typed output on.
+        '''
+        if not output.strip() or TYPED_OUTPUT_PATTERN.match(output):
+            return True
+        collectd.warning('%s: HAProxy socket at %s does not support typed output, falling back to CSV'
+                         % (PLUGIN_NAME, self.socket_file))
+        self.typed = False
+        return False
+
+    def get_workers(self):
+        '''Get the current workers from the master CLI.
+
+        Returns:
+            a list of (relative PID, PID) tuples, leaving out old workers still
+            finishing their connections after a reload
+        '''
+        return _parse_workers(self.communicate('show proc'))
+
+    def get_worker_stats(self, proxy_types=-1):
+        '''Get server info, server stats and resolvers of every current worker through the master CLI.
+
+        The commands of all workers go out in a single batch, routed with
+        '@!<PID>' prefixes over the one master session.
+
+        Returns:
+            a list of (relative PID, server info, server stats, resolvers) tuples
+        '''
+        workers = self.get_workers()
+        stats_commands = _get_stats_commands(proxy_types, self.typed)
+        commands = ['@!%s %s' % (pid, command) for _, pid in workers for command in stats_commands]
+        responses = self.communicate_batch(commands)
+        if workers and self.typed and not self._check_typed(responses[0]):
+            stats_commands = _get_stats_commands(proxy_types)
+            commands = ['@!%s %s' % (pid, command) for _, pid in workers for command in stats_commands]
+            responses = self.communicate_batch(commands)
+        result = []
+        for i, (relative_pid, _) in enumerate(workers):
+            info, stat, resolvers = responses[i * len(stats_commands):(i + 1) * len(stats_commands)]
+            result.append((relative_pid, _parse_server_info(info), _parse_server_stats(stat),
+                           _parse_resolvers(resolvers)))
+        return result
+
+
+def _stat_command(proxy_types, typed=False):
+    command = 'show stat'
+    if proxy_types != -1:
+        command += ' -1 %d -1' % proxy_types
+    if typed:
+        command += ' typed'
+    return command
+
+
+def _get_stats_commands(proxy_types, typed=False):
+    # 'show resolvers' goes last as its output contains empty lines, see communicate_batch
+    return ['show info typed' if typed else 'show info', _stat_command(proxy_types, typed), 'show resolvers']
+
+
+def _get_command_name(data):
+    """
+        Returns the name of the command in data the round trip times of SelfMetrics are kept by: the word after
+        'show', e.g. 'stat' for 'show stat -1 6 -1 typed', or 'batch' for pipelined commands
+    """
+    commands = data.strip().replace(';', '\n').split('\n')
+    if len(commands) > 1:
+        return 'batch'
+    words = commands[0].split()
+    # commands routed to a worker by the master CLI start with '@!<pid>'
+    if words and words[0].startswith('@'):
+        words = words[1:]
+    if len(words) > 1 and words[0] == 'show':
+        return words[1]
+    return words[0] if words else ''
+
+
+def _is_prompt(data):
+    prompt = PROMPT_PATTERN.match('\n' + data)
+    return prompt is not None and prompt.end() == len(data) + 1
+
+
+def _parse_workers(output):
+    """
+        Returns the (relative PID, PID) of the current workers listed by 'show proc', leaving out the old workers
+        and programs listed under headings of their own. HAProxy 2.5 and later dropped the <relative PID> column,
+        so the workers are then numbered in the order listed.
+    """
+    workers = []
+    relative_pid_column = None
+    section = None
+    for line in output.splitlines():
+        if line.startswith('#<PID>'):
+            columns = line[1:].split()
+            if '<relative' in columns:
+                relative_pid_column = columns.index('<relative')
+            continue
+        if line.startswith('#'):
+            section = line[1:].strip()
+            continue
+        fields = line.split()
+        if section != 'workers' or len(fields) < 2 or fields[1] != 'worker':
+            continue
+        if relative_pid_column is None:
+            workers.append((str(len(workers) + 1), fields[0]))
+        elif len(fields) > relative_pid_column and fields[relative_pid_column].isdigit():
+            workers.append((fields[relative_pid_column], fields[0]))
+    return workers
+
+
+def _split_batch_output(output, count):
+    """
+        Splits the output of a ';' separated command batch into the responses of each command.
+        Every response but the last runs up to the first empty line.
+    """
+    responses = []
+    start = 0
+    for _ in range(count - 1):
+        if output.startswith('\n', start):
+            responses.append('')
+            start += 1
+            continue
+        end = output.find('\n\n', start)
+        if end == -1:
+            end = len(output)
+        responses.append(output[start:end + 1])
+        start = end + 2
+    responses.append(output[start:])
+    return responses
+
+
+def _parse_server_info(output):
+    if TYPED_OUTPUT_PATTERN.match(output):
+        return _parse_typed_server_info(output)
+    result = {}
+    for line in output.splitlines():
+        try:
+            key, val = line.split(':', 1)
+        except ValueError:
+            continue
+        result[key.strip()] = val.strip()
+
+    return result
+
+
+def _parse_typed_server_info(output):
+    # lines look like '<field pos>.<field name>.<process>:<tags>:<type>:<value>'
+    result = {}
+    for line in output.splitlines():
+        fields = line.split(':', 3)
+        if len(fields) < 4:
+            continue
+        name = fields[0].split('.')[1]
+        result[name] = _convert_typed_field(name, fields[2], fields[3])
+    return result
+
+
+def _convert_typed_field(name, field_type, value):
+    """
+        Returns the value of a typed output field, as an int if it is a collected integer
+    """
+    if field_type in TYPED_INTEGER_TYPES and value and name in METRIC_CONVERTERS:
+        return int(value)
+    return value
+
+
+class StatLayout(object):
+    """
+        Column layout of a 'show stat' header. Resolves column names to their index once per header,
+        so rows can be read by name regardless of the column order of the HAProxy version.
+    """
+
+    def __init__(self, header):
+        self.header = header
+        columns = header.lstrip('# ').rstrip(',').split(',')
+        self.index = dict((name, i) for i, name in enumerate(columns))
+        self.metrics = tuple((name, i) for i, name in enumerate(columns) if name in METRICS_TO_COLLECT)
+        self._selected_columns = {}
+
+    def get_columns(self, selection):
+        """
+            Returns the (name, index) pairs of the columns of a MetricSelection, resolved once per selection
+        """
+        columns = self._selected_columns.get(selection)
+        if columns is None:
+            columns = tuple((name, i) for name, i in self.metrics if name in selection.converters)
+            self._selected_columns[selection] = columns
+        return columns
+
+
+class StatRow(object):
+    """
+        A read-only, dict like view of a single 'show stat' row
+    """
+    __slots__ = ('fields', 'layout')
+
+    def __init__(self, fields, layout):
+        self.fields = fields
+        self.layout = layout
+
+    def __getitem__(self, key):
+        i = self.layout.index[key]
+        return self.fields[i] if i < len(self.fields) else None
+
+    def __contains__(self, key):
+        return key in self.layout.index
+
+    def __len__(self):
+        return len(self.layout.index)
+
+    def get(self, key, default=None):
+        return self[key] if key in self.layout.index else default
+
+    def items(self):
+        """
+            Returns the (name, value) pairs of the columns listed in METRICS_TO_COLLECT only
+        """
+        fields = self.fields
+        size = len(fields)
+        return [(name, fields[i]) for name, i in self.layout.metrics if i < size]
+
+    def select(self, selection):
+        """
+            Returns the (name, value) pairs of the columns of a MetricSelection only
+        """
+        fields = self.fields
+        size = len(fields)
+        return [(name, fields[i]) for name, i in self.layout.get_columns(selection) if i < size]
+
+
+_stat_layouts = {}
+
+
+def _get_stat_layout(header):
+    """
+        Returns the StatLayout of a header, reusing the one built for the same header in an earlier interval
+    """
+    layout = _stat_layouts.get(header)
+    if layout is None:
+        layout = _stat_layouts[header] = StatLayout(header)
+    return layout
+
+
+def _split_stat_line(line):
+    # HAProxy only quotes fields holding a separator, e.g. some check descriptions
+    if '"' in line:
+        return next(csv.reader([line]))
+    return line.split(',')
+
+
+def _iter_server_stats(lines):
+    layout = None
+    for line in lines:
+        if layout is None:
+            layout = _get_stat_layout(line)
+        elif line:
+            yield StatRow(_split_stat_line(line), layout)
+
+
+def _iter_typed_server_stats(lines):
+    """
+        Yields a dict per proxy, server or listener of 'show stat typed' output, holding its pxname, svname and
+        type along with the values of the collected metrics only
+    """
+    # lines look like '<object type>.<iid>.<sid>.<field pos>.<field name>.<process>:<tags>:<type>:<value>',
+    # with the fields of each object on consecutive lines
+    row = None
+    row_object = None
+    for line in lines:
+        fields = line.split(':', 3)
+        if len(fields) < 4:
+            continue
+        name_fields = fields[0].split('.')
+        if len(name_fields) < 6:
+            continue
+        if name_fields[:3] != row_object:
+            if row is not None:
+                yield row
+            row_object = name_fields[:3]
+            row = {'type': TYPED_OBJECT_TYPES.get(name_fields[0])}
+        name = name_fields[4]
+        if name in ('pxname', 'svname'):
+            row[name] = fields[3]
+        elif name in METRIC_CONVERTERS:
+            row[name] = _convert_typed_field(name, fields[2], fields[3])
+    if row is not None:
+        yield row
+
+
+def _parse_server_stats(output):
+    if TYPED_OUTPUT_PATTERN.match(output):
+        return list(_iter_typed_server_stats(output.splitlines()))
+    return list(_iter_server_stats(output.splitlines()))
+
+
+def _parse_tables(output):
+    tables = []
+    for line in output.splitlines():
+        match = TABLE_HEADER_PATTERN.match(line)
+        if match:
+            tables.append({'table': match.group('table'), 'type': match.group('type'),
+                           'size': int(match.group('size')), 'used': int(match.group('used'))})
+    return tables
+
+
+def _parse_table_entry(line):
+    """
+        Parses an entry of 'show table <name>', e.g.
+        0x55d7c4cbd5e0: key=10.0.0.1 use=0 exp=299934 gpc0=2 conn_rate(30000)=1 http_req_rate(10000)=3
+    """
+    _, separator, fields = line.partition(': ')
+    if not separator:
+        return None
+    key = None
+    # string keys may hold spaces, so the key runs up to the use field following it
+    if fields.startswith('key='):
+        key, separator, fields = fields[len('key='):].partition(' use=')
+        fields = 'use=' + fields if separator else ''
+    columns = []
+    for field in fields.split(' '):
+        name, _, value = field.partition('=')
+        # drop the period of rates, e.g. conn_rate(30000)
+        name = name.split('(', 1)[0]
+        if TABLE_COLUMN_PATTERN.match(name):
+            try:
+                columns.append((name, int(value)))
+            except ValueError:
+                continue
+    return key, columns
+
+
+def _parse_activity(output):
+    """
+        Parses 'show activity', whose counters since 2.0 are the total followed by each thread's value in
+        brackets, e.g. 'loops: 198620 [ 49730 49537 49707 49646 ]', and in 1.9 each thread's value alone
+    """
+    activity = OrderedDict()
+    for line in output.splitlines():
+        name, separator, values = line.partition(':')
+        name = name.strip()
+        if not separator or name not in ACTIVITY_METRICS:
+            continue
+        try:
+            values = [int(value) for value in values.replace('[', ' ').replace(']', ' ').split()]
+        except ValueError:
+            continue
+        if not values:
+            continue
+        if '[' in line:
+            activity[name] = values[0], values[1:]
+        else:
+            # the total of a gauge such as an average isn't the sum of the threads' values
+            activity[name] = sum(values) if ACTIVITY_METRICS[name] == 'derive' else None, values
+    return activity
+
+
+def _parse_pools(output):
+    """
+        Parses 'show pools', e.g.
+          - Pool pipe (16 bytes) : 5 allocated (80 bytes), 5 used, needed_avg 0, 0 failures, 2 users [SHARED]
+        Total: 19 pools, 2197004 bytes allocated, 1916228 used.
+    """
+    pools = OrderedDict()
+    totals = {}
+    for line in output.splitlines():
+        match = POOL_PATTERN.search(line)
+        if match:
+            size, allocated, used = int(match.group('size')), int(match.group('allocated')), int(match.group('used'))
+            pool = pools.setdefault(match.group('pool'), OrderedDict((name, 0) for name in POOL_METRICS))
+            # pools of the same name and different sizes add up
+            pool['allocated'] += allocated
+            pool['allocated_bytes'] += int(match.group('allocated_bytes'))
+            pool['used'] += used
+            pool['used_bytes'] += used * size
+            pool['failures'] += int(match.group('failures'))
+            continue
+        match = POOL_TOTAL_PATTERN.search(line)
+        if match:
+            totals = OrderedDict([('allocated_bytes', int(match.group('allocated_bytes'))),
+                                  ('used_bytes', int(match.group('used_bytes')))])
+    return pools, totals
+
+
+def _parse_tasks(output):
+    """
+        Parses 'show tasks', e.g.
+        Running tasks: 5 (4 threads)
+          function                     places     %    lat_tot   lat_avg
+          process_stream                    3   60.0      -         -
+    """
+    running = None
+    functions = OrderedDict()
+    for line in output.splitlines():
+        match = TASKS_RUNNING_PATTERN.match(line)
+        if match:
+            running = int(match.group(1))
+            continue
+        fields = line.split()
+        if len(fields) >= 2 and fields[1].isdigit():
+            functions[fields[0]] = functions.get(fields[0], 0) + int(fields[1])
+    return running, functions
+
+
+def _summarize_sessions(lines):
+    """
+        Counts the sessions of 'show sess' lines, e.g.
+        0x55d7c4cbd5e0: proto=tcpv4 src=10.0.0.1:5360 fe=http-in be=web srv=web1 ts=00 age=3s calls=2 ...
+    """
+    total = 0
+    per_frontend = {}
+    for line in lines:
+        match = SESSION_FRONTEND_PATTERN.search(line)
+        if match:
+            total += 1
+            frontend = match.group(1)
+            per_frontend[frontend] = per_frontend.get(frontend, 0) + 1
+    return total, per_frontend
+
+
+# This function isn't nice but there's no other way to parse the output of show resolvers from haproxy
+def _parse_resolvers(output):
+    result = {}
+    nameserver = ''
+    for line in output.splitlines():
+        try:
+            if 'Resolvers section' in line or line.strip() == '':
+                continue
+            elif 'nameserver' in line:
+                _, unsanitied_nameserver = line.strip().split(' ', 1)
+                nameserver = unsanitied_nameserver[:-1]  # remove trailing ':'
+                result[nameserver] = {}
+            else:
+                key, val = line.split(':', 1)
+                current_nameserver_stats = result[nameserver]
+                current_nameserver_stats[key.strip()] = val.strip()
+                result[nameserver] = current_nameserver_stats
+        except ValueError:
+            continue
+
+    return result
+
+
+def get_module_stats(module_config):
+    """
+        Fetches the stats of the module from its socket, sockets or master socket, in the format of get_stats
+    """
+    if module_config['master']:
+        stats = get_master_stats(module_config)
+    elif len(module_config['sockets']) > 1:
+        stats = get_multi_socket_stats(module_config)
+    else:
+        stats = get_stats(module_config)
+    if module_config['server_aggregation'] is not None:
+        stats = module_config['server_aggregation'].aggregate(stats)
+    if module_config['burst_sampler'] is not None:
+        # started here rather than at config time, as threads don't survive collectd daemonizing
+        module_config['burst_sampler'].start()
+        stats = itertools.chain(stats, module_config['burst_sampler'].drain())
+    return stats
+
+
+class SnapshotPoller(object):
+    """
+        Polls HAProxy every poll_interval seconds on a thread of its own, publishing each complete result as an
+        immutable snapshot for the read callback to dispatch. Readers keep the snapshot they got while the next
+        one is built, so no locking is needed.
+    """
+
+    def __init__(self, module_config, poll_interval):
+        self.module_config = module_config
+        self.poll_interval = poll_interval
+        # tuple of the time.time() the snapshot was taken at and the tuple of stats, replaced as a whole
+        self.latest = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='haproxy poller %s' % self.module_config['socket'])
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            started = time.time()
+            try:
+                stats = tuple(get_module_stats(self.module_config))
+                if self.module_config['self_metrics']:
+                    self.module_config['collector_stats'].add('collect_time', time.time() - started)
+            except Exception as e:
+                collectd.error('%s: Polling HAProxy socket at %s failed: %s'
+                               % (PLUGIN_NAME, self.module_config['socket'], e))
+                stats = None
+            # a failed poll leaves the previous snapshot to go stale
+            if stats:
+                self.latest = (started, stats)
+            self._stopped.wait(max(self.poll_interval - (time.time() - started), 0))
+
+
+class BurstSampler(object):
+    """
+        Samples a few gauges every sample_interval seconds on a thread of its own, so that spikes shorter than
+        the collection interval show. Each series keeps the max, sum, count and last value of its samples in
+        fixed-size arrays, which every collection drains into <metric>_burst_max, _burst_avg and _burst_last
+        gauges instead of dispatching every sample.
+    """
+
+    def __init__(self, module_config, sample_interval, metric_names):
+        self.module_config = module_config
+        self.sample_interval = sample_interval
+        self.metric_names = tuple(metric_names)
+        # (process, series key, metric name) -> index of the series in the arrays
+        self._slots = {}
+        # per slot, the metric name and dimensions of the series
+        self._series = []
+        self._max = array.array('d')
+        self._sum = array.array('d')
+        self._last = array.array('d')
+        self._count = array.array('l')
+        self._lock = threading.Lock()
+        self._sockets = {}
+        # socket files whose last sample failed, so each failure is only logged when it starts
+        self._failing = set()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='haproxy sampler %s' % self.module_config['socket'])
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            started = time.time()
+            self.sample()
+            self._stopped.wait(max(self.sample_interval - (time.time() - started), 0))
+
+    def sample(self):
+        sockets = self.module_config['sockets']
+        for process, socket_file in enumerate(sockets, 1):
+            haproxy = self._sockets.get(socket_file)
+            if haproxy is None:
+                haproxy = self._sockets[socket_file] = HAProxySocket(socket_file)
+            # a sample must not hold up the next one
+            haproxy.deadline = time.time() + self.sample_interval
+            try:
+                samples = self._read_samples(haproxy, process if len(sockets) > 1 else None)
+            except socket.error as e:
+                if socket_file not in self._failing:
+                    collectd.warning('%s: Sampling HAProxy socket at %s failed: %s' % (PLUGIN_NAME, socket_file, e))
+                    self._failing.add(socket_file)
+                continue
+            self._failing.discard(socket_file)
+            self._record(samples)
+
+    def _read_samples(self, haproxy, process):
+        stat_kwarg = {}
+        if self.module_config['proxy_types'] != -1:
+            stat_kwarg['proxy_types'] = self.module_config['proxy_types']
+        samples = []
+        for row in haproxy.get_server_stats(**stat_kwarg):
+            if not should_capture_metric(row, self.module_config):
+                continue
+            dimensions = None
+            for metric_name in self.metric_names:
+                value = _parse_int(row.get(metric_name))
+                if value is None:
+                    continue
+                if dimensions is None:
+                    dimensions = dict((name, row[name]) for name in ('pxname', 'svname', 'type') if name in row)
+                    if process is not None:
+                        dimensions['process'] = str(process)
+                samples.append((metric_name, value, dimensions))
+        return samples
+
+    def _record(self, samples):
+        with self._lock:
+            for metric_name, value, dimensions in samples:
+                key = _get_series_key(dimensions), metric_name
+                slot = self._slots.get(key)
+                if slot is None:
+                    slot = self._slots[key] = len(self._series)
+                    self._series.append((metric_name, dimensions))
+                    self._max.append(value)
+                    self._sum.append(0)
+                    self._last.append(0)
+                    self._count.append(0)
+                elif self._count[slot] == 0 or value > self._max[slot]:
+                    self._max[slot] = value
+                self._sum[slot] += value
+                self._last[slot] = value
+                self._count[slot] += 1
+
+    def drain(self):
+        """
+            Returns the burst gauges of the samples taken since the last drain, in the format of get_stats
+        """
+        stats = []
+        with self._lock:
+            for slot, (metric_name, dimensions) in enumerate(self._series):
+                count = self._count[slot]
+                if count == 0:
+                    continue
+                for statistic, value in (('max', self._max[slot]), ('avg', self._sum[slot] / count),
+                                         ('last', self._last[slot])):
+                    stats.append((metric_name, value, dict(dimensions, burst=statistic)))
+                self._sum[slot] = 0
+                self._count[slot] = 0
+        return stats
+
+
+def get_snapshot_stats(module_config):
+    """
+        Returns the stats of the latest snapshot of the module's poller, or none if it is stale
+    """
+    poller = module_config['poller']
+    # started here rather than at config time, as threads don't survive collectd daemonizing
+    poller.start()
+    latest = poller.latest
+    if latest is None:
+        return ()
+    taken_at, stats = latest
+    age = time.time() - taken_at
+    _submit_collector_metric('gauge', 'snapshot_age', age)
+    if age > module_config['stale_after']:
+        # sockets held open by their circuit breaker were logged as unreachable once already
+        if not _all_circuits_open(module_config):
+            collectd.warning('%s: Latest snapshot of HAProxy socket at %s is stale, taken %.1fs ago'
+                             % (PLUGIN_NAME, module_config['socket'], age))
+        return ()
+    return stats
+
+
+class WorkerPool(object):
+    """
+        A fixed number of daemon threads working through a shared queue of calls
+    """
+
+    def __init__(self, size):
+        self.tasks = Queue.Queue()
+        for _ in range(size):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+
+    def _work(self):
+        while True:
+            func, arg, results, index, done = self.tasks.get()
+            try:
+                results[index] = func(arg)
+            except Exception as e:
+                results[index] = e
+            done.release()
+
+    def map(self, func, args):
+        """
+            Calls func with each of args on the worker threads, and returns the results once all calls are done.
+            An exception raised by a call is raised again here.
+        """
+        results = [None] * len(args)
+        done = threading.Semaphore(0)
+        for index, arg in enumerate(args):
+            self.tasks.put((func, arg, results, index, done))
+        for _ in args:
+            done.acquire()
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return results
 
 
-class HAProxySocket(object):
+def get_multi_socket_stats(module_config):
     """
-            Encapsulates communication with HAProxy via the socket interface
+        Fetches the stats of every configured socket concurrently, on a pool of at most MaxWorkers threads.
+        Returns them in the format of get_stats, tagged with the process number of their socket or, with
+        AggregateProcesses, merged into a single set of stats.
     """
+    if module_config.get('worker_pool') is None:
+        module_config['worker_pool'] = WorkerPool(min(module_config['max_workers'], len(module_config['sockets'])))
+    per_process_stats = module_config['worker_pool'].map(
+        lambda socket_file: list(get_stats(module_config, socket_file)), module_config['sockets'])
+    if module_config['aggregate_processes']:
+        return _aggregate_process_stats(enumerate(per_process_stats, 1))
+    return _tag_process_stats(enumerate(per_process_stats, 1))
 
-    def __init__(self, socket_file=DEFAULT_SOCKET):
-        self.socket_file = socket_file
 
-    def connect(self):
-        # unix sockets all start with '/', use tcp otherwise
-        is_unix = self.socket_file.startswith('/')
-        if is_unix:
-            stat_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-            stat_sock.connect(self.socket_file)
-            return stat_sock
-        else:
-            socket_host, separator, port = self.socket_file.rpartition(':')
-            if socket_host != '' and port != '' and separator == ':':
-                stat_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                stat_sock.connect((socket_host, int(port)))
-                return stat_sock
+def _aggregate_process_stats(per_process_stats):
+    """
+        Merges the stats of (process, stats) pairs into per proxy totals. Stick tables and internals such as
+        pools and the event loop are each process' own, so their stats are tagged with their process instead.
+    """
+    totals = OrderedDict()
+    untotalled = []
+    for process, stats in per_process_stats:
+        process_stats = []
+        untotalled.append((process, process_stats))
+        for metric_name, metric_value, dimensions in stats:
+            if is_table_metric(dimensions) or is_internal_metric(dimensions):
+                process_stats.append((metric_name, metric_value, dimensions))
+                continue
+            if metric_name not in METRICS_TO_COLLECT:
+                continue
+            key = (metric_name, _get_series_key(dimensions))
+            if key not in totals:
+                totals[key] = [metric_name, metric_value, dimensions]
+            elif metric_name in AGGREGATE_WITH_MAX:
+                totals[key][1] = max(totals[key][1], metric_value)
             else:
-                collectd.error('Could not connect to socket with host %s. Check HAProxy config.' % self.socket_file)
-                return
+                totals[key][1] += metric_value
+    return [tuple(total) for total in totals.itervalues()] + list(_tag_process_stats(untotalled))
 
-    def communicate(self, command):
-        '''Get response from single command.
-
-        Args:
-            command: string command to send to haproxy stat socket
 
-        Returns:
-            a string of the response data
-        '''
-        if not command.endswith('\n'):
-            command += '\n'
-        stat_sock = self.connect()
-        if stat_sock is None:
-            return ''
-        stat_sock.sendall(command)
-        result_buf = StringIO.StringIO()
-        buf = stat_sock.recv(RECV_SIZE)
-        while buf:
-            result_buf.write(buf)
-            buf = stat_sock.recv(RECV_SIZE)
-
-        stat_sock.close()
-        return result_buf.getvalue()
+class ServerAggregation(object):
+    """
+        Aggregates the columns of the servers of each backend into their sum, min, max and mean and, with
+        percentiles, p50 and p95, in a single pass over the stats. Passes the other stats through, along with the
+        per-server values unless drop_servers is set.
+    """
 
-    # This method isn't nice but there's no other way to parse the output of show resolvers from haproxy
-    def get_resolvers(self):
-        ''' Gets the resolver config and returns a map of nameserver -> nameservermetrics
-        The output from the socket looks like
-        Resolvers section mydns
-         nameserver dns1:
-          sent:        8
-          ...
+    def __init__(self, metric_names, percentiles=False, drop_servers=False):
+        self.metric_names = frozenset(metric_names)
+        self.percentiles = percentiles
+        self.drop_servers = drop_servers
 
-        :return:
-        map of nameserver -> nameservermetrics
-        e.g. '{dns1': {'sent': '8', ...}, ...}
-        '''
-        result = {}
-        output = self.communicate('show resolvers')
-        nameserver = ''
-        for line in output.splitlines():
-            try:
-                if 'Resolvers section' in line or line.strip() == '':
-                    continue
-                elif 'nameserver' in line:
-                    _, unsanitied_nameserver = line.strip().split(' ', 1)
-                    nameserver = unsanitied_nameserver[:-1]  # remove trailing ':'
-                    result[nameserver] = {}
-                else:
-                    key, val = line.split(':', 1)
-                    current_nameserver_stats = result[nameserver]
-                    current_nameserver_stats[key.strip()] = val.strip()
-                    result[nameserver] = current_nameserver_stats
-            except ValueError:
+    def aggregate(self, stats):
+        # (process, pxname) -> metric name -> [sum, min, max, count, values]
+        backends = OrderedDict()
+        for metric_name, metric_value, dimensions in stats:
+            if not is_backend_server_metric(dimensions):
+                yield metric_name, metric_value, dimensions
                 continue
+            if metric_name in self.metric_names:
+                key = dimensions.get('process'), dimensions['pxname']
+                columns = backends.get(key)
+                if columns is None:
+                    columns = backends[key] = OrderedDict()
+                column = columns.get(metric_name)
+                if column is None:
+                    columns[metric_name] = [metric_value, metric_value, metric_value, 1, [metric_value]]
+                else:
+                    column[0] += metric_value
+                    column[1] = min(column[1], metric_value)
+                    column[2] = max(column[2], metric_value)
+                    column[3] += 1
+                    if self.percentiles:
+                        column[4].append(metric_value)
+            if not self.drop_servers:
+                yield metric_name, metric_value, dimensions
 
-        return result
+        for (process, pxname), columns in backends.iteritems():
+            for statistic in SERVER_AGGREGATE_STATISTICS + (('p50', 'p95') if self.percentiles else ()):
+                # metrics of the same backend and statistic share their dimensions, like the metrics of a row
+                dimensions = {'is_server_aggregate': True, 'pxname': pxname, 'aggregate': statistic}
+                if process is not None:
+                    dimensions['process'] = process
+                for metric_name, column in columns.iteritems():
+                    yield metric_name, self._get_statistic(statistic, column), dimensions
 
-    def get_server_info(self):
-        result = {}
-        output = self.communicate('show info')
-        for line in output.splitlines():
-            try:
-                key, val = line.split(':', 1)
-            except ValueError:
-                continue
-            result[key.strip()] = val.strip()
+    @staticmethod
+    def _get_statistic(statistic, column):
+        total, minimum, maximum, count, values = column
+        if statistic == 'sum':
+            return total
+        elif statistic == 'min':
+            return minimum
+        elif statistic == 'max':
+            return maximum
+        elif statistic == 'mean':
+            return float(total) / count
+        # nearest-rank percentile
+        values.sort()
+        rank = int(statistic[1:])
+        return values[max(0, (rank * len(values) + 99) // 100 - 1)]
 
-        return result
 
-    def get_server_stats(self):
-        output = self.communicate('show stat')
-        # sanitize and make a list of lines
-        output = output.lstrip('# ').strip()
-        output = [l.strip(',') for l in output.splitlines()]
-        csvreader = csv.DictReader(output)
-        result = [d.copy() for d in csvreader]
-        return result
+def _get_series_key(dimensions):
+    if is_resolver_metric(dimensions):
+        key = dimensions['nameserver']
+    elif is_server_aggregate_metric(dimensions):
+        key = dimensions['pxname'], dimensions['aggregate']
+    elif is_table_metric(dimensions):
+        key = 'table', dimensions['table']
+    elif is_internal_metric(dimensions):
+        key = dimensions['source'], dimensions.get('instance')
+    elif 'burst' in dimensions:
+        key = dimensions['pxname'], dimensions['svname'], dimensions.get('type'), dimensions['burst']
+    elif 'pxname' in dimensions:
+        key = dimensions['pxname'], dimensions['svname'], dimensions.get('type')
+    else:
+        key = None
+    return dimensions.get('process'), key
+
 
+def _tag_process_stats(per_process_stats):
+    for process, stats in per_process_stats:
+        # stats of the same row share their dimensions, so tag them once per row
+        tagged_dimensions = {}
+        for metric_name, metric_value, dimensions in stats:
+            key = id(dimensions)
+            if key not in tagged_dimensions:
+                tagged_dimensions[key] = dict((name, dimensions[name])
+                                              for name in ('pxname', 'svname', 'type', 'is_resolver', 'nameserver',
+                                                           'is_table', 'table', 'is_internal', 'source', 'instance')
+                                              if name in dimensions)
+                tagged_dimensions[key]['process'] = str(process)
+            yield metric_name, metric_value, tagged_dimensions[key]
 
-def get_stats(module_config):
+
+def get_stats(module_config, socket_file=None):
     """
-        Makes two calls to haproxy to fetch server info and server stats.
-        Returns the dict containing metric name as the key and a tuple of metric value and the dict of dimensions if any
+        Fetches server info, server stats and resolvers from haproxy, through the configured socket unless
+        socket_file is given.
+        Yields tuples of metric name, metric value and the dict of dimensions if any. Unless the commands are
+        pipelined or a Timeout is set, server stats are yielded while the rest of the response is still being read.
     """
-    if module_config['socket'] is None:
+    if socket_file is None:
+        socket_file = module_config['socket']
+    if socket_file is None:
         collectd.error("Socket configuration parameter is undefined. Couldn't get the stats")
         return
-    stats = []
-    haproxy = HAProxySocket(module_config['socket'])
+    breaker = _get_circuit_breaker(module_config, socket_file)
+    if breaker is not None and not breaker.allow():
+        return
+    haproxy = _get_haproxy_socket(module_config, socket_file)
+    stats = _iter_socket_stats(haproxy, module_config)
 
     try:
+        if module_config['timeout'] is not None:
+            # only a complete result is dispatched, so hold it back until the deadline can't cut it short
+            haproxy.deadline = time.time() + module_config['timeout']
+            stats = list(stats)
+        for stat in stats:
+            yield stat
+    except socket.timeout as e:
+        _count_timeout(module_config, socket_file)
+        if breaker is not None:
+            breaker.record_failure(e)
+    except socket.error as e:
+        if module_config.get('self_metrics'):
+            module_config['collector_stats'].add('errors', 1)
+        if breaker is not None:
+            breaker.record_failure(e)
+        else:
+            collectd.warning('status err Unable to connect to HAProxy socket at %s' % socket_file)
+    else:
+        if breaker is not None:
+            breaker.record_success()
+
+
+def _iter_socket_stats(haproxy, module_config):
+    for stat in _iter_proxy_stats(haproxy, module_config):
+        yield stat
+    if module_config['stick_tables']:
+        for stat in _iter_table_stats(haproxy, module_config):
+            yield stat
+    if module_config['internals']:
+        for stat in _iter_internal_stats(haproxy, module_config['internals']):
+            yield stat
+
+
+def _iter_proxy_stats(haproxy, module_config):
+    if module_config['shared_snapshot_ttl'] is not None:
+        server_info, server_stats, resolver_stats = shared_snapshots.get(
+            (haproxy.socket_file, module_config['typed']), module_config['shared_snapshot_ttl'],
+            lambda: _fetch_snapshot(haproxy, module_config))
+        for stat in _iter_fetched_stats(server_info, server_stats, resolver_stats, module_config):
+            yield stat
+        return
+
+    stat_kwarg = {}
+    if module_config['proxy_types'] != -1:
+        stat_kwarg['proxy_types'] = module_config['proxy_types']
+
+    cache = module_config['source_cache']
+    socket_file = haproxy.socket_file
+    server_info = cache.get(socket_file, 'info')
+    server_stats = cache.get(socket_file, 'stat')
+    resolver_stats = cache.get(socket_file, 'resolvers')
+    if module_config['pipeline'] and server_info is None and server_stats is None and resolver_stats is None:
+        server_info, server_stats, resolver_stats = haproxy.get_all_stats(**stat_kwarg)
+        server_info = cache.put(socket_file, 'info', server_info)
+        server_stats = cache.put(socket_file, 'stat', server_stats)
+        resolver_stats = cache.put(socket_file, 'resolvers', resolver_stats)
+    else:
+        if server_info is None:
+            server_info = cache.put(socket_file, 'info', haproxy.get_server_info())
+        if server_stats is None:
+            server_stats = cache.put(socket_file, 'stat', haproxy.get_server_stats(**stat_kwarg))
+
+    for stat in _iter_server_info_stats(server_info, module_config):
+        yield stat
+    for stat in _iter_server_stats_stats(server_stats, module_config):
+        yield stat
+    if resolver_stats is None:
+        resolver_stats = cache.put(socket_file, 'resolvers', haproxy.get_resolvers())
+    for stat in _iter_resolver_stats(resolver_stats, module_config):
+        yield stat
+
+
+def _iter_table_stats(haproxy, module_config):
+    """
+        Yields the size and use of each stick table and, for the tables of StickTableEntries, the aggregates of
+        their entries, streamed through a TableAggregator
+    """
+    for table in haproxy.get_tables():
+        dimensions = {'is_table': True, 'table': table['table']}
+        yield 'size', table['size'], dimensions
+        yield 'used', table['used'], dimensions
+        if any(fnmatch.fnmatchcase(table['table'], pattern) for pattern in module_config['table_entries']):
+            aggregator = TableAggregator(module_config['table_top_n'])
+            for key, columns in haproxy.iter_table_entries(table['table']):
+                aggregator.add(key, columns)
+            for metric_name, metric_value in aggregator.iter_stats():
+                yield metric_name, metric_value, dimensions
+
+
+def _iter_internal_stats(haproxy, sources):
+    """
+        Yields the metrics of HAProxy's internals of the enabled sources, 'activity', 'pool', 'tasks' and
+        'sessions', each under dimensions of its source and, per thread, pool or task function, an instance
+    """
+    if 'activity' in sources:
+        for metric_name, (total, threads) in haproxy.get_activity().iteritems():
+            if total is not None:
+                yield metric_name, total, {'is_internal': True, 'source': 'activity'}
+            for thread, value in enumerate(threads, 1):
+                yield metric_name, value, {'is_internal': True, 'source': 'activity', 'instance': 'thread.%d' % thread}
+    if 'pool' in sources:
+        pools, totals = haproxy.get_pools()
+        for pool, pool_stats in pools.iteritems():
+            dimensions = {'is_internal': True, 'source': 'pool', 'instance': pool}
+            for metric_name, value in pool_stats.iteritems():
+                yield metric_name, value, dimensions
+        dimensions = {'is_internal': True, 'source': 'pool'}
+        for metric_name, value in totals.iteritems():
+            yield metric_name, value, dimensions
+    if 'tasks' in sources:
+        running, functions = haproxy.get_tasks()
+        if running is not None:
+            yield 'running', running, {'is_internal': True, 'source': 'tasks'}
+        for function, places in functions.iteritems():
+            yield 'places', places, {'is_internal': True, 'source': 'tasks', 'instance': function}
+    if 'sessions' in sources:
+        total, per_frontend = haproxy.get_sessions_summary()
+        yield 'sessions', total, {'is_internal': True, 'source': 'sessions'}
+        for frontend, sessions in per_frontend.iteritems():
+            yield 'sessions', sessions, {'is_internal': True, 'source': 'sessions', 'instance': frontend}
+
+
+class TableAggregator(object):
+    """
+        Aggregates the gpc and rate columns of the entries of a stick table in bounded memory, however many
+        entries it has: the sum and max of each column, its top_n keys kept in a heap and its quantiles
+        estimated from a uniform sample of TABLE_SAMPLE_SIZE values.
+    """
+
+    def __init__(self, top_n):
+        self.top_n = top_n
+        self.entries = 0
+        # column -> [sum, max, count, heap of the (value, key) of its top_n, sample of its values]
+        self.columns = OrderedDict()
+
+    def add(self, key, columns):
+        self.entries += 1
+        for name, value in columns:
+            column = self.columns.get(name)
+            if column is None:
+                column = self.columns[name] = [0, value, 0, [], []]
+            column[0] += value
+            column[1] = max(column[1], value)
+            column[2] += 1
+            top = column[3]
+            if len(top) < self.top_n:
+                heapq.heappush(top, (value, key))
+            elif value > top[0][0]:
+                heapq.heapreplace(top, (value, key))
+            # reservoir sampling, each value ends up in the sample with the same probability
+            sample = column[4]
+            if len(sample) < TABLE_SAMPLE_SIZE:
+                sample.append(value)
+            else:
+                i = random.randint(0, column[2] - 1)
+                if i < TABLE_SAMPLE_SIZE:
+                    sample[i] = value
+
+    def iter_stats(self):
+        yield 'entries', self.entries
+        for name, (total, maximum, _, top, sample) in self.columns.iteritems():
+            yield name + '_sum', total
+            yield name + '_max', maximum
+            sample.sort()
+            for quantile in TABLE_QUANTILES:
+                yield '%s_p%d' % (name, quantile), sample[max(0, (quantile * len(sample) + 99) // 100 - 1)]
+            for value, key in sorted(top, reverse=True):
+                yield '%s_top.%s' % (name, _format_table_key(key)), value
+
+
+def _format_table_key(key):
+    """
+        Returns a stick table key fit for a type instance, see TABLE_KEY_UNSAFE_PATTERN
+    """
+    formatted = TABLE_KEY_UNSAFE_PATTERN.sub('_', key)
+    if len(formatted) > TABLE_KEY_MAX_LENGTH:
+        formatted = '%s_%s' % (formatted[:TABLE_KEY_MAX_LENGTH - 9], hashlib.md5(key).hexdigest()[:8])
+    return formatted
+
+
+def _iter_fetched_stats(server_info, server_stats, resolver_stats, module_config):
+    for stat in _iter_server_info_stats(server_info, module_config):
+        yield stat
+    for stat in _iter_server_stats_stats(server_stats, module_config):
+        yield stat
+    for stat in _iter_resolver_stats(resolver_stats, module_config):
+        yield stat
+
+
+def _fetch_snapshot(haproxy, module_config):
+    """
+        Fetches the unfiltered server info, server stats and resolvers of a socket for a SharedSnapshots, each
+        Module block filtering them by its own ProxyMonitor
+    """
+    if module_config['pipeline']:
+        server_info, server_stats, resolver_stats = haproxy.get_all_stats()
+    else:
         server_info = haproxy.get_server_info()
-        server_stats = haproxy.get_server_stats()
+        # the rows are streamed off the socket, so read them all before the next command reuses it
+        server_stats = list(haproxy.get_server_stats())
         resolver_stats = haproxy.get_resolvers()
-    except socket.error:
-        collectd.warning('status err Unable to connect to HAProxy socket at %s' % module_config['socket'])
-        return stats
+        return server_info, server_stats, resolver_stats
+    return server_info, list(server_stats), resolver_stats
+
+
+class SharedSnapshots(object):
+    """
+        Process wide cache of the parsed responses of each socket, shared by the Module blocks with a
+        SharedSnapshotTTL. Blocks collecting from the same socket within the TTL share one fetch and one parse:
+        the first one fetches while the others wait for its result instead of fetching too.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # key -> [lock of the key's fetch, time.time() of the fetch, result]
+        self._entries = {}
+
+    def get(self, key, ttl, fetch):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = [threading.Lock(), None, None]
+        with entry[0]:
+            if entry[1] is None or time.time() - entry[1] >= ttl:
+                fetched_at = time.time()
+                entry[2] = fetch()
+                entry[1] = fetched_at
+            return entry[2]
+
+
+shared_snapshots = SharedSnapshots()
+
+
+class SourceCache(object):
+    """
+        The results of the sources with an interval of their own, InfoInterval, StatInterval or ResolversInterval,
+        reused across collections until their interval has passed, so each command only hits the socket at its
+        own cadence.
+    """
+
+    def __init__(self, intervals):
+        # 'info', 'stat' or 'resolvers' -> seconds
+        self.intervals = intervals
+        # (socket file, source) -> (time.time() it was fetched at, result)
+        self._results = {}
+
+    def get(self, socket_file, source):
+        """
+            Returns the cached result of the source, or None when it is due to be fetched
+        """
+        interval = self.intervals.get(source)
+        if not interval:
+            return None
+        cached = self._results.get((socket_file, source))
+        if cached is not None and time.time() - cached[0] < interval:
+            return cached[1]
+        return None
+
+    def put(self, socket_file, source, result):
+        """
+            Caches a freshly fetched result of the source if it has an interval, returning the result to use
+        """
+        if self.intervals.get(source):
+            if not isinstance(result, dict):
+                # server stats are streamed, so keep them to be read again
+                result = list(result)
+            self._results[(socket_file, source)] = (time.time(), result)
+        return result
+
+
+_timeouts_lock = threading.Lock()
+
+
+def _count_timeout(module_config, socket_file):
+    with _timeouts_lock:
+        module_config['timeouts'] += 1
+    collectd.warning('%s: Timed out after %ss collecting from HAProxy socket at %s, discarding partial result'
+                     % (PLUGIN_NAME, module_config['timeout'], socket_file))
+
 
+def get_master_stats(module_config):
+    """
+        Fetches the stats of every worker through the master CLI socket, in the format of get_multi_socket_stats
+    """
+    breaker = _get_circuit_breaker(module_config, module_config['socket'])
+    if breaker is not None and not breaker.allow():
+        return []
+    haproxy = _get_haproxy_socket(module_config, module_config['socket'])
+    stat_kwarg = {}
+    if module_config['proxy_types'] != -1:
+        stat_kwarg['proxy_types'] = module_config['proxy_types']
+    if module_config['timeout'] is not None:
+        haproxy.deadline = time.time() + module_config['timeout']
+    try:
+        worker_stats = haproxy.get_worker_stats(**stat_kwarg)
+    except socket.timeout as e:
+        _count_timeout(module_config, module_config['socket'])
+        if breaker is not None:
+            breaker.record_failure(e)
+        return []
+    except socket.error as e:
+        if module_config.get('self_metrics'):
+            module_config['collector_stats'].add('errors', 1)
+        if breaker is not None:
+            breaker.record_failure(e)
+        else:
+            collectd.warning('status err Unable to connect to HAProxy master socket at %s' % module_config['socket'])
+        return []
+    if breaker is not None:
+        breaker.record_success()
+
+    per_process_stats = []
+    for relative_pid, server_info, server_stats, resolver_stats in worker_stats:
+        stats = list(_iter_server_info_stats(server_info, module_config))
+        stats.extend(_iter_server_stats_stats(server_stats, module_config))
+        stats.extend(_iter_resolver_stats(resolver_stats, module_config))
+        per_process_stats.append((relative_pid, stats))
+    if module_config['aggregate_processes']:
+        return _aggregate_process_stats(per_process_stats)
+    return _tag_process_stats(per_process_stats)
+
+
+def _iter_server_info_stats(server_info, module_config):
     # server wide stats
+    converters = module_config['metric_selection'].converters
     for key, val in server_info.iteritems():
-        try:
-            stats.append((key, int(val), dict()))
-        except (TypeError, ValueError):
-            pass
+        converter = converters.get(key)
+        if converter is not None:
+            val = converter(val)
+            if val is not None:
+                yield key, val, dict()
 
+
+def _iter_server_stats_stats(server_stats, module_config):
     # proxy specific stats
+    selection = module_config['metric_selection']
+    converters = selection.converters
+    rows_seen = rows_filtered = 0
     for statdict in server_stats:
+        rows_seen += 1
         if not should_capture_metric(statdict, module_config):
+            rows_filtered += 1
             continue
-        for metricname, val in statdict.items():
-            try:
-                stats.append((metricname, int(val), statdict))
-            except (TypeError, ValueError):
-                pass
+        items = statdict.select(selection) if isinstance(statdict, StatRow) else statdict.items()
+        for metricname, val in items:
+            converter = converters.get(metricname)
+            if converter is not None:
+                val = converter(val)
+                if val is not None:
+                    yield metricname, val, statdict
+    if module_config.get('self_metrics'):
+        module_config['collector_stats'].add('rows_seen', rows_seen)
+        module_config['collector_stats'].add('rows_filtered', rows_filtered)
 
-    for resolver, resolver_stats in resolver_stats.iteritems():
-        for metricname, val in resolver_stats.items():
-            try:
-                stats.append((metricname, int(val), {'is_resolver': True, 'nameserver': resolver}))
-            except (TypeError, ValueError):
-                pass
-    return stats
+
+def _iter_resolver_stats(resolver_stats, module_config):
+    converters = module_config['metric_selection'].converters
+    for resolver, nameserver_stats in resolver_stats.iteritems():
+        for metricname, val in nameserver_stats.items():
+            converter = converters.get(metricname)
+            if converter is not None:
+                val = converter(val)
+                if val is not None:
+                    yield metricname, val, {'is_resolver': True, 'nameserver': resolver}
+
+
+def _parse_int(val):
+    """
+        Converts a numeric field to an int, returning None rather than raising for empty or non numeric fields.
+        Fields of typed output are ints already.
+    """
+    if isinstance(val, (int, long)):
+        return val
+    elif not val:
+        return None
+    elif val.isdigit() or val[0] == '-' and val[1:].isdigit():
+        return int(val)
+    return None
+
+
+# The converter of each collected column, all others are skipped without being looked at
+METRIC_CONVERTERS = dict((metric_name, _parse_int) for metric_name in METRICS_TO_COLLECT)
+
+
+class MetricSelection(object):
+    """
+        The metrics a module collects, along with their converters
+    """
+
+    def __init__(self, metric_names):
+        self.converters = dict((name, METRIC_CONVERTERS[name]) for name in metric_names)
+
+
+class CollectorStats(object):
+    """
+        Counters of the plugin's own work, added to by the collecting threads over a collection and dispatched
+        under the collector plugin instance with SelfMetrics
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+
+    def add(self, name, value):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def drain(self):
+        """
+            Returns the counters since the last call, resetting them
+        """
+        with self._lock:
+            counters, self._counters = self._counters, {}
+        return counters
+
+
+def _compile_metric_selection(enhanced_metrics, included_metrics, excluded_metrics):
+    """
+        Returns the MetricSelection of the basic or, with enhanced_metrics, all metrics, plus the ones matching
+        any of the included_metrics glob patterns, minus the ones matching any of the excluded_metrics
+    """
+    def matches(metric_name, patterns):
+        return any(fnmatch.fnmatchcase(metric_name.lower(), pattern.lower()) for pattern in patterns)
+
+    metric_names = set(METRICS_TO_COLLECT if enhanced_metrics else BASIC_METRICS)
+    metric_names.update(name for name in METRICS_TO_COLLECT if matches(name, included_metrics))
+    metric_names.difference_update([name for name in metric_names if matches(name, excluded_metrics)])
+    return MetricSelection(metric_names)
+
+
+class CircuitBreaker(object):
+    """
+        Tracks whether a socket can be collected from. A failure opens the circuit, leaving the socket alone for
+        a backoff that doubles with every consecutive failure up to max_backoff, with jitter so that modules
+        failing together don't retry together. Once the backoff is over a single collection probes the socket
+        (half-open), closing the circuit if it succeeds or reopening it for longer otherwise. Only changes
+        between reachable and unreachable are logged.
+    """
+
+    def __init__(self, socket_file, initial_backoff, max_backoff):
+        self.socket_file = socket_file
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.state = 'closed'
+        self.failures = 0
+        self.retry_at = None
+
+    @property
+    def up(self):
+        return self.state == 'closed'
+
+    def allow(self):
+        """
+            Returns whether the socket may be collected from now
+        """
+        if self.state == 'open':
+            if time.time() < self.retry_at:
+                return False
+            self.state = 'half-open'
+        return True
+
+    def record_success(self):
+        if self.state != 'closed':
+            collectd.info('%s: HAProxy socket at %s is reachable again after %d failed attempts'
+                          % (PLUGIN_NAME, self.socket_file, self.failures))
+        self.state = 'closed'
+        self.failures = 0
+
+    def record_failure(self, error):
+        self.failures += 1
+        backoff = min(self.initial_backoff * 2 ** (self.failures - 1), self.max_backoff)
+        backoff = random.uniform(backoff / 2, backoff)
+        self.retry_at = time.time() + backoff
+        if self.state == 'closed':
+            collectd.warning('status err Unable to connect to HAProxy socket at %s (%s), backing off for up to %ss'
+                             % (self.socket_file, error, self.max_backoff))
+        self.state = 'open'
+
+
+def _get_circuit_breaker(module_config, socket_file):
+    """
+        Returns the CircuitBreaker of the socket, or None without CircuitBreaker
+    """
+    if not module_config.get('circuit_breaker'):
+        return None
+    breakers = module_config['circuit_breakers']
+    if socket_file not in breakers:
+        breakers[socket_file] = CircuitBreaker(socket_file, module_config['initial_backoff'],
+                                               module_config['max_backoff'])
+    return breakers[socket_file]
+
+
+def _all_circuits_open(module_config):
+    """
+        Returns whether every socket of the module is left alone or failed its probe, going by its CircuitBreaker
+    """
+    if not module_config.get('circuit_breaker'):
+        return False
+    breakers = module_config['circuit_breakers']
+    return all(socket_file in breakers and not breakers[socket_file].up for socket_file in module_config['sockets'])
+
+
+def _submit_up_metrics(module_config):
+    """
+        Dispatches whether each socket of the module is reachable, as the collector up gauge
+    """
+    sockets = module_config['sockets']
+    for process, socket_file in enumerate(sockets, 1):
+        breaker = module_config['circuit_breakers'].get(socket_file)
+        if breaker is not None:
+            plugin_instance = 'process.%d.collector' % process if len(sockets) > 1 else 'collector'
+            _submit_collector_metric('gauge', 'up', int(breaker.up), plugin_instance)
+
+
+def _get_haproxy_socket(module_config, socket_file):
+    """
+        Returns the HAProxySocket to collect with. The same instance, along with its receive buffer and in
+        persistent mode its stats session, is reused across intervals.
+    """
+    haproxy_sockets = module_config.setdefault('haproxy_sockets', {})
+    if haproxy_sockets.get(socket_file) is None:
+        socket_kwarg = {}
+        if module_config['persistent']:
+            socket_kwarg['persistent'] = True
+        if module_config['master']:
+            socket_kwarg['master'] = True
+        if module_config['typed']:
+            socket_kwarg['typed'] = True
+        if module_config['capture'] is not None:
+            socket_kwarg['capture'] = module_config['capture']
+        if module_config['replay'] is not None:
+            socket_kwarg['replay'] = module_config['replay']
+        haproxy_sockets[socket_file] = HAProxySocket(socket_file, **socket_kwarg)
+    return haproxy_sockets[socket_file]
 
 
 def should_capture_metric(statdict, module_config):
@@ -199,6 +2122,20 @@ def should_capture_metric(statdict, module_config):
             is_backend_server_metric(statdict) and 'backend' in module_config['proxy_monitors'])
 
 
+def _get_proxy_type_filter(proxy_monitors):
+    """
+        Translates the proxy monitors into the type bitmask of 'show stat', so that HAProxy only sends
+        the rows should_capture_metric can keep. Proxy names are matched against server names too,
+        which no HAProxy filter can express, so any name disables the filter (-1).
+    """
+    proxy_types = 0
+    for monitor in proxy_monitors:
+        if monitor.lower() not in PROXY_TYPE_FILTERS:
+            return -1
+        proxy_types |= PROXY_TYPE_FILTERS[monitor.lower()]
+    return proxy_types
+
+
 def is_backend_server_metric(statdict):
     return 'type' in statdict and _get_proxy_type(statdict['type']) == 'server'
 
@@ -207,6 +2144,18 @@ def is_resolver_metric(statdict):
     return 'is_resolver' in statdict and statdict['is_resolver']
 
 
+def is_internal_metric(statdict):
+    return 'is_internal' in statdict and statdict['is_internal']
+
+
+def is_table_metric(statdict):
+    return 'is_table' in statdict and statdict['is_table']
+
+
+def is_server_aggregate_metric(statdict):
+    return 'is_server_aggregate' in statdict and statdict['is_server_aggregate']
+
+
 def config(config_values):
     """
     A callback method that  loads information from the HaProxy collectd plugin config file.
@@ -216,11 +2165,44 @@ def config(config_values):
 
     module_config = {}
     socket = DEFAULT_SOCKET
+    sockets = [socket]
+    max_workers = DEFAULT_MAX_WORKERS
+    aggregate_processes = False
+    master = False
+    timeout = None
+    background = False
+    poll_interval = None
+    stale_after = None
+    verbose = False
+    typed = False
     proxy_monitors = []
+    included_metrics = set()
+    suppress_unchanged = False
+    aggregated_server_metrics = set()
+    burst_metrics = set()
+    source_intervals = {}
+    shared_snapshot_ttl = None
+    self_metrics = False
+    capture_file = None
+    replay_file = None
+    replay_mmap = False
+    circuit_breaker = False
+    grouped = False
+    stick_tables = False
+    table_entries = set()
+    table_top_n = DEFAULT_TABLE_TOP_N
+    internals = []
+    max_backoff = DEFAULT_MAX_BACKOFF
+    burst_sample_interval = DEFAULT_BURST_SAMPLE_INTERVAL
+    aggregate_server_percentiles = False
+    drop_server_metrics = False
+    heartbeat_intervals = DEFAULT_HEARTBEAT_INTERVALS
     excluded_metrics = set()
     enhanced_metrics = False
     interval = None
     testing = False
+    persistent = False
+    pipeline = False
     custom_dimensions = {}
 
     for node in config_values.children:
@@ -228,10 +2210,93 @@ def config(config_values):
             proxy_monitors.extend(node.values)
         elif node.key == "Socket" and node.values[0]:
             socket = node.values[0]
+            sockets = list(node.values)
+        elif node.key == "MaxWorkers" and node.values[0]:
+            max_workers = int(node.values[0])
+        elif node.key == "AggregateProcesses" and node.values[0]:
+            aggregate_processes = _str_to_bool(node.values[0])
+        elif node.key == "MasterSocket" and node.values[0]:
+            master = _str_to_bool(node.values[0])
+        elif node.key == "Timeout" and node.values[0]:
+            timeout = float(node.values[0])
+        elif node.key == "TypedOutput" and node.values[0]:
+            typed = _str_to_bool(node.values[0])
+        elif node.key == "EnhancedMetrics" and node.values[0]:
+            enhanced_metrics = _str_to_bool(node.values[0])
+        elif node.key == "IncludeMetric" and node.values[0]:
+            included_metrics.update(node.values)
+        elif node.key == "ExcludeMetric" and node.values[0]:
+            excluded_metrics.update(node.values)
+        elif node.key == "SuppressUnchanged" and node.values[0]:
+            suppress_unchanged = _str_to_bool(node.values[0])
+        elif node.key == "HeartbeatInterval" and node.values[0]:
+            heartbeat_intervals = int(node.values[0])
+        elif node.key == "AggregateServerMetric" and node.values[0]:
+            aggregated_server_metrics.update(node.values)
+        elif node.key == "AggregateServerPercentiles" and node.values[0]:
+            aggregate_server_percentiles = _str_to_bool(node.values[0])
+        elif node.key == "DropServerMetrics" and node.values[0]:
+            drop_server_metrics = _str_to_bool(node.values[0])
+        elif node.key == "BurstMetric" and node.values[0]:
+            burst_metrics.update(node.values)
+        elif node.key == "BurstSampleInterval" and node.values[0]:
+            burst_sample_interval = float(node.values[0])
+        elif node.key == "InfoInterval" and node.values[0]:
+            source_intervals['info'] = float(node.values[0])
+        elif node.key == "StatInterval" and node.values[0]:
+            source_intervals['stat'] = float(node.values[0])
+        elif node.key == "ResolversInterval" and node.values[0]:
+            source_intervals['resolvers'] = float(node.values[0])
+        elif node.key == "SharedSnapshotTTL" and node.values[0]:
+            shared_snapshot_ttl = float(node.values[0])
+        elif node.key == "SelfMetrics" and node.values[0]:
+            self_metrics = _str_to_bool(node.values[0])
+        elif node.key == "CaptureFile" and node.values[0]:
+            capture_file = node.values[0]
+        elif node.key == "ReplayFile" and node.values[0]:
+            replay_file = node.values[0]
+        elif node.key == "ReplayMmap" and node.values[0]:
+            replay_mmap = _str_to_bool(node.values[0])
+        elif node.key == "CircuitBreaker" and node.values[0]:
+            circuit_breaker = _str_to_bool(node.values[0])
+        elif node.key == "MaxBackoff" and node.values[0]:
+            max_backoff = float(node.values[0])
+        elif node.key == "GroupMetrics" and node.values[0]:
+            grouped = _str_to_bool(node.values[0])
+        elif node.key == "StickTables" and node.values[0]:
+            stick_tables = _str_to_bool(node.values[0])
+        elif node.key == "StickTableEntries" and node.values[0]:
+            table_entries.update(node.values)
+        elif node.key == "StickTableTopN" and node.values[0]:
+            table_top_n = int(node.values[0])
+        elif node.key == "ActivityMetrics" and node.values[0]:
+            if _str_to_bool(node.values[0]):
+                internals.append('activity')
+        elif node.key == "PoolMetrics" and node.values[0]:
+            if _str_to_bool(node.values[0]):
+                internals.append('pool')
+        elif node.key == "TaskMetrics" and node.values[0]:
+            if _str_to_bool(node.values[0]):
+                internals.append('tasks')
+        elif node.key == "SessionMetrics" and node.values[0]:
+            if _str_to_bool(node.values[0]):
+                internals.append('sessions')
+        elif node.key == "Verbose" and node.values[0]:
+            verbose = _str_to_bool(node.values[0])
+        elif node.key == "BackgroundPolling" and node.values[0]:
+            background = _str_to_bool(node.values[0])
+        elif node.key == "PollInterval" and node.values[0]:
+            poll_interval = float(node.values[0])
+        elif node.key == "StaleAfter" and node.values[0]:
+            stale_after = float(node.values[0])
         elif node.key == "Interval" and node.values[0]:
             interval = node.values[0]
         elif node.key == "Testing" and node.values[0]:
             testing = _str_to_bool(node.values[0])
+        elif node.key == "PersistentConnection" and node.values[0]:
+            persistent = _str_to_bool(node.values[0])
+        elif node.key == "PipelineCommands" and node.values[0]:
+            pipeline = _str_to_bool(node.values[0])
         elif node.key == 'Dimension':
             if len(node.values) == 2:
                 custom_dimensions.update({node.values[0]: node.values[1]})
@@ -246,13 +2311,61 @@ def config(config_values):
 
     module_config = {
         'socket': socket,
+        'sockets': sockets,
+        'max_workers': max_workers,
+        'aggregate_processes': aggregate_processes,
+        'master': master,
+        'timeout': timeout,
+        'timeouts': 0,
         'proxy_monitors': proxy_monitors,
+        'proxy_types': _get_proxy_type_filter(proxy_monitors),
         'interval': interval,
         'enhanced_metrics': enhanced_metrics,
+        'included_metrics': included_metrics,
         'excluded_metrics': excluded_metrics,
+        'metric_selection': _compile_metric_selection(enhanced_metrics, included_metrics, excluded_metrics),
         'custom_dimensions': custom_dimensions,
         'testing': testing,
+        'persistent': persistent,
+        'pipeline': pipeline,
+        'background': background,
+        'stale_after': stale_after,
+        'verbose': verbose,
+        'typed': typed,
+        'dispatch_plan': DispatchPlan(heartbeat_intervals if suppress_unchanged else None),
+        'server_aggregation': None,
+        'burst_sampler': None,
+        'source_cache': SourceCache(source_intervals),
+        'shared_snapshot_ttl': shared_snapshot_ttl,
+        'self_metrics': self_metrics,
+        'collector_stats': CollectorStats(),
+        'capture': CaptureWriter(capture_file) if capture_file else None,
+        'replay': CaptureReplay(replay_file, replay_mmap) if replay_file else None,
+        'circuit_breaker': circuit_breaker,
+        'grouped': grouped,
+        'stick_tables': stick_tables or bool(table_entries),
+        'table_entries': table_entries,
+        'table_top_n': table_top_n,
+        'internals': frozenset(internals),
+        'circuit_breakers': {},
+        # the first retry comes about an interval after a failure
+        'initial_backoff': float(interval or DEFAULT_POLL_INTERVAL),
+        'max_backoff': max_backoff,
     }
+    if master and (internals or module_config['stick_tables']):
+        collectd.warning('%s: StickTables, StickTableEntries, ActivityMetrics, PoolMetrics, TaskMetrics and '
+                         'SessionMetrics are not collected through a MasterSocket' % PLUGIN_NAME)
+    if aggregated_server_metrics:
+        module_config['server_aggregation'] = ServerAggregation(
+            _get_known_metrics('AggregateServerMetric', aggregated_server_metrics),
+            aggregate_server_percentiles, drop_server_metrics)
+    if burst_metrics and not master:
+        module_config['burst_sampler'] = BurstSampler(
+            module_config, burst_sample_interval, _get_known_metrics('BurstMetric', burst_metrics))
+    if background:
+        poll_interval = poll_interval or float(interval or DEFAULT_POLL_INTERVAL)
+        module_config['stale_after'] = stale_after or 3 * poll_interval
+        module_config['poller'] = SnapshotPoller(module_config, poll_interval)
     proxys = "_".join(proxy_monitors)
 
     if testing:
@@ -264,13 +2377,45 @@ def config(config_values):
     collectd.register_read(collect_metrics, data=module_config,
                            name='node_' + module_config['socket'] + '_' + proxys,
                            **interval_kwarg)
+    if background:
+        collectd.register_shutdown(module_config['poller'].stop)
+    if module_config['burst_sampler'] is not None:
+        collectd.register_shutdown(module_config['burst_sampler'].stop)
+
+
+def _get_known_metrics(config_key, metric_names):
+    """
+        Returns the metric names given to config_key that are in METRICS_TO_COLLECT, warning about the others
+    """
+    unknown = sorted(name for name in metric_names if name not in METRICS_TO_COLLECT)
+    if unknown:
+        collectd.warning('%s: Ignoring unknown %s metrics: %s' % (PLUGIN_NAME, config_key, ', '.join(unknown)))
+    return [name for name in metric_names if name in METRICS_TO_COLLECT]
 
 
 def _format_plugin_instance(dimensions):
+    if 'process' in dimensions:
+        # stats of one of the processes of a multi socket module, see get_multi_socket_stats
+        plugin_instance = "process.{0}".format(dimensions['process'])
+        if len(dimensions) > 1:
+            plugin_instance += "." + _format_proxy_instance(dimensions)
+        return plugin_instance
+    return _format_proxy_instance(dimensions)
+
+
+def _format_proxy_instance(dimensions):
     if is_backend_server_metric(dimensions):
         return "{0}.{1}.{2}".format("backend", dimensions['pxname'].lower(), dimensions['svname'])
     elif is_resolver_metric(dimensions):
         return "nameserver.{0}".format(dimensions['nameserver'])
+    elif is_server_aggregate_metric(dimensions):
+        return "servers.{0}".format(dimensions['pxname'].lower())
+    elif is_table_metric(dimensions):
+        return "table.{0}".format(dimensions['table'])
+    elif is_internal_metric(dimensions):
+        if 'instance' in dimensions:
+            return "{0}.{1}".format(dimensions['source'], dimensions['instance'])
+        return dimensions['source']
     else:
         return "{0}.{1}".format(dimensions['svname'].lower(), dimensions['pxname'])
 
@@ -303,16 +2448,192 @@ def _str_to_bool(val):
     return False
 
 
+class DispatchSeries(object):
+    """
+        The plugin instance of a series a DispatchPlan dispatches, along with the last values sent of its gauges
+        when unchanged gauges are suppressed
+    """
+    __slots__ = ('plugin_instance', 'kind', 'entries', 'last_values', 'unsent_intervals')
+
+    def __init__(self, plugin_instance, kind, entries):
+        self.plugin_instance = plugin_instance
+        self.kind = kind
+        # the entries of the metric names of the series' kind, shared by every series of the kind
+        self.entries = entries
+        self.last_values = None
+        self.unsent_intervals = None
+
+
+class DispatchPlan(object):
+    """
+        The plugin instances of the series dispatched, keyed by process, proxy/server/type or nameserver, and the
+        type and type instance of each metric name. Built as series and metrics are first seen, so the plugin
+        instance is formatted once per series rather than once per value. Series that stop being reported, e.g.
+        after a reload removed a proxy, are dropped at the end of the collection.
+
+        With heartbeat_intervals set, gauges whose value didn't change since they were last dispatched are
+        suppressed, but re-sent every heartbeat_intervals intervals so downstream staleness detection keeps working.
+        The last values sent are kept in an array per series, indexed by a slot per gauge of the series' kind.
+    """
+
+    def __init__(self, heartbeat_intervals=None):
+        self.heartbeat_intervals = heartbeat_intervals
+        self.suppressed = 0
+        self._series = {}
+        self._entries = {}
+        self._slots = {}
+        self._seen = set()
+        self._last_dimensions = None
+        self._last_series = None
+
+    def get_entry(self, metric_name, dimensions):
+        """
+            Returns the (type, type_instance, slot) to dispatch a metric of the series with, or None if it isn't
+            collected. The slot indexes the last values of suppressed gauges, None for values never suppressed.
+        """
+        # the metrics of a row come one after the other and share the row's dimensions
+        if dimensions is not self._last_dimensions:
+            key = _get_series_key(dimensions)
+            self._seen.add(key)
+            self._last_series = self._series.get(key)
+            if self._last_series is None:
+                plugin_instance = _format_plugin_instance(dimensions) if len(dimensions) > 0 else None
+                kind = _get_series_kind(dimensions)
+                self._last_series = self._series[key] = DispatchSeries(
+                    plugin_instance, kind, self._entries.setdefault(kind, {}))
+            self._last_dimensions = dimensions
+        entries = self._last_series.entries
+        entry = entries.get(metric_name)
+        if entry is None and is_table_metric(dimensions) and '_top.' in metric_name:
+            # the top keys of a stick table come and go, so don't keep an entry for every key ever seen
+            return 'gauge', metric_name, None
+        if entry is None and (metric_name in METRICS_TO_COLLECT or metric_name in GROUPED_METRICS or
+                              is_table_metric(dimensions) or is_internal_metric(dimensions)):
+            metric_type, type_instance = self._build_entry(metric_name, dimensions)
+            slot = None
+            if metric_type == 'gauge':
+                # the series of a kind share their slots, so their arrays of last values hold no gaps
+                kind = self._last_series.kind
+                slot = self._slots[kind] = self._slots.get(kind, -1) + 1
+            entry = entries[metric_name] = metric_type, type_instance, slot
+        return entry
+
+    @staticmethod
+    def _build_entry(metric_name, dimensions):
+        if is_table_metric(dimensions):
+            return 'gauge', metric_name
+        if is_internal_metric(dimensions):
+            return INTERNAL_METRIC_TYPES[dimensions['source']][metric_name], metric_name.lower()
+        if metric_name in GROUPED_METRICS:
+            # a multi-value data set of haproxy_types.db, named by its type alone
+            return metric_name, ''
+        if is_server_aggregate_metric(dimensions):
+            metric_type = 'gauge' if dimensions['aggregate'] == 'mean' else METRICS_TO_COLLECT[metric_name]
+            return metric_type, metric_name.lower() + '_' + dimensions['aggregate']
+        if 'burst' in dimensions:
+            return 'gauge', metric_name.lower() + '_burst_' + dimensions['burst']
+        return METRICS_TO_COLLECT[metric_name], metric_name.lower()
+
+    def should_dispatch(self, entry, value):
+        """
+            Returns whether a value of an entry of the last series is to be dispatched, recording it as sent if so
+        """
+        slot = entry[2]
+        if self.heartbeat_intervals is None or slot is None or not isinstance(value, (int, long, float)):
+            return True
+        series = self._last_series
+        if series.last_values is None:
+            series.last_values = array.array('d')
+            series.unsent_intervals = array.array('I')
+        if slot >= len(series.last_values):
+            missing = slot + 1 - len(series.last_values)
+            # NaN compares unequal to every value, so the first value of a gauge is always sent
+            series.last_values.extend([float('nan')] * missing)
+            series.unsent_intervals.extend([0] * missing)
+        if value == series.last_values[slot] and series.unsent_intervals[slot] + 1 < self.heartbeat_intervals:
+            series.unsent_intervals[slot] += 1
+            self.suppressed += 1
+            return False
+        series.last_values[slot] = value
+        series.unsent_intervals[slot] = 0
+        return True
+
+    def get_datapoint(self, entry, values):
+        """
+            Returns the datapoint of values of an entry of the last series
+        """
+        datapoint = {'plugin': PLUGIN_NAME, 'type': entry[0], 'type_instance': entry[1], 'values': values}
+        if self._last_series.plugin_instance is not None:
+            datapoint['plugin_instance'] = self._last_series.plugin_instance
+        return datapoint
+
+    def end_collection(self):
+        self.suppressed = 0
+        if len(self._series) > len(self._seen):
+            for key in set(self._series) - self._seen:
+                del self._series[key]
+        self._seen = set()
+        self._last_dimensions = self._last_series = None
+
+
+def _get_series_kind(dimensions):
+    """
+        Returns what, besides the metric name, the type and type instance of the metrics of a series depend on
+    """
+    if is_table_metric(dimensions):
+        return 'table'
+    if is_internal_metric(dimensions):
+        return 'internal', dimensions['source']
+    if is_server_aggregate_metric(dimensions):
+        return 'aggregate', dimensions['aggregate']
+    if 'burst' in dimensions:
+        return 'burst', dimensions['burst']
+    return None
+
+
+def _group_stats(stats):
+    """
+        Merges the metrics of each row making up a GROUPED_METRICS data set into one stat of the data set's
+        name and a tuple of the values, passing the other stats through. A data set missing any of its
+        metrics in a row is passed through metric by metric.
+    """
+    row = None
+    grouped = {}
+    for stat in stats:
+        metric_name, metric_value, dimensions = stat
+        if dimensions is not row:
+            for grouped_stat in _iter_grouped_stats(grouped, row):
+                yield grouped_stat
+            row = dimensions
+            grouped = {}
+        # per-backend aggregates and burst samples can be fractional, which derive data sets can't hold
+        if metric_name in GROUPED_METRIC_NAMES and not is_server_aggregate_metric(dimensions) \
+                and 'burst' not in dimensions:
+            grouped[metric_name] = metric_value
+        else:
+            yield stat
+    for grouped_stat in _iter_grouped_stats(grouped, row):
+        yield grouped_stat
+
+
+def _iter_grouped_stats(grouped, dimensions):
+    if not grouped:
+        return
+    for data_set, metric_names in GROUPED_METRICS.iteritems():
+        if all(metric_name in grouped for metric_name in metric_names):
+            yield data_set, tuple(grouped.pop(metric_name) for metric_name in metric_names), dimensions
+    for metric_name, metric_value in grouped.iteritems():
+        yield metric_name, metric_value, dimensions
+
+
 def submit_metrics(metric_datapoint):
-    datapoint = collectd.Values()
-    datapoint.type = metric_datapoint['type']
-    datapoint.type_instance = metric_datapoint['type_instance']
-    datapoint.plugin = metric_datapoint['plugin']
-    if 'plugin_instance' in metric_datapoint.keys():
-        datapoint.plugin_instance = metric_datapoint['plugin_instance']
-    datapoint.values = metric_datapoint['values']
-    collectd.debug(pprint.pformat(metric_datapoint))
-    datapoint.dispatch()
+    """
+        Dispatches a metric datapoint through the collectd.Values shared by every datapoint, see DISPATCH_VALUES
+    """
+    DISPATCH_VALUES.dispatch(plugin=metric_datapoint['plugin'],
+                             plugin_instance=metric_datapoint.get('plugin_instance', ''),
+                             type=metric_datapoint['type'], type_instance=metric_datapoint['type_instance'],
+                             values=metric_datapoint['values'])
 
 
 def collect_metrics(module_config):
@@ -321,28 +2642,99 @@ def collect_metrics(module_config):
         A callback method that gets metrics from HAProxy and records them to collectd.
     """
 
-    info = get_stats(module_config)
+    self_metrics = module_config['self_metrics']
+    if module_config['background']:
+        stats = get_snapshot_stats(module_config)
+    else:
+        started = time.time()
+        stats = get_module_stats(module_config)
+        if self_metrics:
+            # read everything first, so the time taken is apart from dispatching
+            stats = list(stats)
+            module_config['collector_stats'].add('collect_time', time.time() - started)
 
-    if not info:
-        collectd.warning('%s: No data received' % PLUGIN_NAME)
-        return
+    if module_config['grouped']:
+        stats = _group_stats(stats)
 
-    for metric_name, metric_value, dimensions in info:
+    dispatch_started = time.time()
+    dispatched = 0
+    dispatch_plan = module_config['dispatch_plan']
+    verbose = module_config['verbose']
+    suppress = dispatch_plan.heartbeat_intervals is not None
+    received = False
+    for metric_name, metric_value, dimensions in stats:
+        received = True
+        entry = dispatch_plan.get_entry(metric_name, dimensions)
         # assert metric is in valid metrics lists
-        if metric_name not in METRICS_TO_COLLECT:
-            collectd.debug("metric %s is not in list of metrics to collect" % metric_name.lower())
+        if entry is None:
+            if verbose:
+                collectd.debug("metric %s is not in list of metrics to collect" % metric_name.lower())
             continue
 
-        metric_datapoint = {
-                    'plugin': PLUGIN_NAME,
-                    'type': METRICS_TO_COLLECT[metric_name],
-                    'type_instance': metric_name.lower(),
-                    'values': (metric_value,)
-                }
-        if len(dimensions) > 0:
-            metric_datapoint['plugin_instance'] = _format_plugin_instance(dimensions)
-        collectd.debug(pprint.pformat(metric_datapoint))
+        if suppress and not dispatch_plan.should_dispatch(entry, metric_value):
+            continue
+        metric_datapoint = dispatch_plan.get_datapoint(
+            entry, metric_value if isinstance(metric_value, tuple) else (metric_value,))
+        if verbose:
+            collectd.debug(pprint.pformat(metric_datapoint))
         submit_metrics(metric_datapoint)
+        dispatched += 1
+    if self_metrics:
+        collector_stats = module_config['collector_stats']
+        collector_stats.add('values_dispatched', dispatched)
+        collector_stats.add('dispatch_time', time.time() - dispatch_started)
+        _submit_self_metrics(module_config)
+    if dispatch_plan.heartbeat_intervals is not None:
+        _submit_collector_metric('gauge', 'suppressed', dispatch_plan.suppressed)
+    dispatch_plan.end_collection()
+
+    # sockets held open by their circuit breaker were logged as unreachable once already
+    if not received and not _all_circuits_open(module_config):
+        collectd.warning('%s: No data received' % PLUGIN_NAME)
+
+    if module_config['timeout'] is not None:
+        _submit_collector_metric('derive', 'timeouts', module_config['timeouts'])
+
+    if module_config['circuit_breaker']:
+        _submit_up_metrics(module_config)
+
+
+def _submit_self_metrics(module_config):
+    """
+        Dispatches the work done by the plugin since the last collection. Parse time is the part of the time
+        spent collecting that wasn't spent connecting or waiting on the socket, which includes converting.
+    """
+    counters = module_config['collector_stats'].drain()
+    command_times = {}
+    for haproxy in module_config.get('haproxy_sockets', {}).values():
+        io_stats = haproxy.drain_io_stats()
+        for command_name, (seconds, count) in io_stats.pop('command_times').iteritems():
+            totals = command_times.setdefault(command_name, [0.0, 0])
+            totals[0] += seconds
+            totals[1] += count
+        for name, value in io_stats.iteritems():
+            counters[name] = counters.get(name, 0) + value
+    if 'collect_time' in counters:
+        counters['parse_time'] = max(
+            counters['collect_time'] - counters.get('connect_time', 0) - counters.get('io_time', 0), 0)
+    for name in SELF_METRICS:
+        _submit_collector_metric('gauge', name, counters.get(name, 0))
+    for command_name, (seconds, count) in sorted(command_times.iteritems()):
+        if count:
+            _submit_collector_metric('gauge', 'rtt_' + command_name, seconds / count)
+
+
+def _submit_collector_metric(metric_type, type_instance, value, plugin_instance='collector'):
+    """
+        Dispatches a metric about the plugin itself
+    """
+    submit_metrics({
+        'plugin': PLUGIN_NAME,
+        'plugin_instance': plugin_instance,
+        'type': metric_type,
+        'type_instance': type_instance,
+        'values': (value,)
+    })
 
 
 collectd.register_config(config)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+"""
+    Records the responses of a live HAProxy stats socket to a capture file, and profiles the plugin against a
+    capture without a live HAProxy, with collectd stubbed out by a stub that counts dispatched values:
+
+        python replay.py record /var/run/haproxy.sock haproxy.cap
+        python replay.py run haproxy.cap --collections 20 --profile
+        python replay.py run haproxy.cap --target get_stats --mmap --objects
+
+    A capture answers the requests it recorded only, so record and run with the same plugin options, e.g.
+    --option PipelineCommands=true for both.
+
+    --tracemalloc needs the tracemalloc module, which the plugin's Python 2 gets from pytracemalloc on a patched
+    interpreter. --objects works on any Python, counting the objects left behind by the collections by type.
+"""
+import argparse
+import cProfile
+import gc
+import pstats
+import time
+from collections import Counter
+
+from benchmark import ConfigNode, CountingValues, ModuleConfig, install_collectd_stub
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+def load_plugin(options):
+    install_collectd_stub()
+    import haproxy
+    children = [ConfigNode('Testing', ('true',))] + [ConfigNode(key, (value,)) for key, value in options]
+    return haproxy, haproxy.config(ModuleConfig(children))
+
+
+def record(args):
+    options = [('Socket', args.socket), ('CaptureFile', args.capture)] + args.option
+    haproxy, module_config = load_plugin(options)
+    for _ in range(args.collections):
+        haproxy.collect_metrics(module_config)
+    module_config['capture'].close()
+    print 'Recorded %d collections, %d values, to %s' % (args.collections, CountingValues.dispatched, args.capture)
+
+
+def count_objects():
+    gc.collect()
+    return Counter(type(obj).__name__ for obj in gc.get_objects())
+
+
+def run(args):
+    if args.tracemalloc and tracemalloc is None:
+        raise SystemExit('tracemalloc is not available on this Python, install pytracemalloc or use --objects')
+    options = [('ReplayFile', args.capture), ('ReplayMmap', str(args.mmap))] + args.option
+    haproxy, module_config = load_plugin(options)
+    if args.target == 'get_stats':
+        def collect():
+            for _ in haproxy.get_module_stats(module_config):
+                pass
+    else:
+        def collect():
+            haproxy.collect_metrics(module_config)
+    # the first collection builds caches and the dispatch plan, which would skew the rest
+    collect()
+    CountingValues.dispatched = 0
+
+    profiler = cProfile.Profile() if args.profile else None
+    objects = count_objects() if args.objects else None
+    if args.tracemalloc:
+        tracemalloc.start(args.tracemalloc)
+    if profiler is not None:
+        profiler.enable()
+    started = time.time()
+    for _ in range(args.collections):
+        collect()
+    wall = time.time() - started
+    if profiler is not None:
+        profiler.disable()
+    print '%d collections of %s in %.3fs, %.2fms each, %d values' % (
+        args.collections, args.target, wall, wall * 1000 / args.collections, CountingValues.dispatched)
+
+    if profiler is not None:
+        stats = pstats.Stats(profiler)
+        if args.profile_output:
+            stats.dump_stats(args.profile_output)
+        stats.sort_stats('cumulative').print_stats(args.top)
+    if args.tracemalloc:
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        for stat in snapshot.statistics('traceback')[:args.top]:
+            print stat
+            for line in stat.traceback.format():
+                print line
+    if objects is not None:
+        growth = count_objects()
+        growth.subtract(objects)
+        print 'Objects left behind by type:'
+        for name, count in growth.most_common(args.top):
+            if count > 0:
+                print '%10d %s' % (count, name)
+
+
+def add_common_arguments(parser):
+    parser.add_argument('--option', action='append', default=[], metavar='KEY=VALUE', type=lambda o: o.split('=', 1),
+                        help='plugin configuration option, e.g. PersistentConnection=true')
+    parser.add_argument('--collections', type=int, default=1, help='collections to record or run')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers()
+
+    record_parser = commands.add_parser('record', help='record the responses of a stats socket')
+    record_parser.add_argument('socket', help='stats socket path or host:port')
+    record_parser.add_argument('capture', help='capture file to write')
+    add_common_arguments(record_parser)
+    record_parser.set_defaults(command=record)
+
+    run_parser = commands.add_parser('run', help='collect from a capture')
+    run_parser.add_argument('capture', help='capture file to read')
+    add_common_arguments(run_parser)
+    run_parser.add_argument('--target', choices=['collect_metrics', 'get_stats'], default='collect_metrics',
+                            help='collect and dispatch, or only collect')
+    run_parser.add_argument('--mmap', action='store_true', help='memory map the capture instead of reading it')
+    run_parser.add_argument('--profile', action='store_true', help='profile the collections with cProfile')
+    run_parser.add_argument('--profile-output', help='file to save the cProfile stats to')
+    run_parser.add_argument('--tracemalloc', type=int, default=0, metavar='FRAMES',
+                            help='trace memory allocations with tracemalloc, keeping this many frames')
+    run_parser.add_argument('--objects', action='store_true',
+                            help='count the objects left behind by the collections, by type')
+    run_parser.add_argument('--top', type=int, default=25, help='profile and allocation entries to print')
+    run_parser.set_defaults(command=run)
+
+    args = parser.parse_args()
+    args.command(args)
+
+
+if __name__ == '__main__':
+    main()
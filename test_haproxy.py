@@ -5,6 +5,11 @@ from mock import Mock
 from mock import patch
 from mock import call
 import sys
+import time
+import os
+import shutil
+import socket
+import tempfile
 
 
 class MockCollectd(MagicMock):
@@ -32,7 +37,7 @@ class MockHAProxySocketSimple(object):
         sample_data = {'ConnRate': '3', 'CumReq': '5', 'Idle_pct': '78'}
         return sample_data
 
-    def get_server_stats(self):
+    def get_server_stats(self, proxy_types=-1):
         sample_data = [{'bin': '3120628', 'lastchg': '', 'lbt': '', 'weight': '',
                         'wretr': '', 'slim': '50', 'pid': '1', 'wredis': '', 'dresp': '0',
                         'ereq': '0', 'pxname': 'sample_proxy', 'stot': '39728',
@@ -45,6 +50,7 @@ class MockHAProxySocketSimple(object):
 sys.modules['collectd'] = MockCollectd()
 
 import haproxy
+submit_metrics = haproxy.submit_metrics
 
 ConfigOption = collections.namedtuple('ConfigOption', ('key', 'values'))
 
@@ -77,7 +83,7 @@ class MockHAProxySocketComplex(object):
         sample_data = {'ConnRate': '3', 'CumReq': '5', 'Idle_pct': '78'}
         return sample_data
 
-    def get_server_stats(self):
+    def get_server_stats(self, proxy_types=-1):
         sample_data = [{'lastchg': '321093', 'agent_health': '', 'check_desc': 'Layer7 check passed',
                          'smax': '2', 'agent_rise': '', 'req_rate': '', 'check_status': 'L7OK', 'wredis': '0',
                          'comp_out': '', 'conn_rate': '', 'cli_abrt': '0', 'pxname': 'elasticsearch_backend',
@@ -314,3 +320,1107 @@ Resolvers section mydns2
                'dns2': {'sent': '0', 'snd_error': '0', 'valid': '0', 'update': '0', 'cname': '0', 'cname_error': '0',
                      'any_err': '0', 'nx': '0', 'timeout': '0', 'refused': '0', 'other': '0', 'invalid': '0',
                      'too_big': '0', 'truncated': '0', 'outdated': '0'}}
+
+
+class FakePromptSocket(object):
+    """
+    Emulates a stats socket in interactive mode, answering each command line from a dict of responses
+    """
+
+    def __init__(self, responses, fail_after=None, prompt='> '):
+        self.responses = responses
+        self.fail_after = fail_after
+        self.prompt = prompt
+        self.commands = []
+        self.pending = ''
+        self.closed = False
+
+    def sendall(self, data):
+        for command in data.splitlines():
+            self.commands.append(command)
+            self.pending += self.responses.get(command, '') + '\n' + self.prompt
+
+    def recv(self, size):
+        if self.fail_after is not None and len(self.commands) > self.fail_after:
+            return ''
+        data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+    def settimeout(self, timeout):
+        pass
+
+    def recv_into(self, buf, size):
+        data = self.recv(size)
+        buf[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        self.closed = True
+
+
+def test_persistent_session_is_reused_across_commands():
+    fake_socket = FakePromptSocket({'show info': 'Name: HAProxy\nUptime_sec: 10\n'})
+    haproxy_socket = haproxy.HAProxySocket('/var/run/haproxy.sock', persistent=True)
+    haproxy_socket.connect = MagicMock(return_value=fake_socket)
+    assert haproxy_socket.get_server_info() == {'Name': 'HAProxy', 'Uptime_sec': '10'}
+    assert haproxy_socket.get_server_info() == {'Name': 'HAProxy', 'Uptime_sec': '10'}
+    assert haproxy_socket.connect.call_count == 1
+    assert fake_socket.commands == ['prompt', 'show info', 'show info']
+
+
+def test_persistent_session_reconnects_when_closed_by_haproxy():
+    stale_socket = FakePromptSocket({}, fail_after=1)
+    fresh_socket = FakePromptSocket({'show info': 'Uptime_sec: 10\n'})
+    haproxy_socket = haproxy.HAProxySocket('/var/run/haproxy.sock', persistent=True)
+    haproxy_socket.connect = MagicMock(side_effect=[stale_socket, fresh_socket])
+    assert haproxy_socket.get_server_info() == {'Uptime_sec': '10'}
+    assert stale_socket.closed
+    assert fresh_socket.commands == ['prompt', 'show info']
+
+
+class FakeSocket(object):
+    """
+    Emulates a non-interactive stats socket, answering ';' separated commands then closing the connection
+    """
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.sent = []
+        self.pending = ''
+
+    def sendall(self, data):
+        self.sent.append(data)
+        for command in data.strip().split(';'):
+            self.pending += self.responses.get(command, '') + '\n'
+
+    def recv(self, size):
+        data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+    def settimeout(self, timeout):
+        pass
+
+    def recv_into(self, buf, size):
+        data = self.recv(size)
+        buf[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        pass
+
+
+BATCH_RESPONSES = {
+    'show info': 'Name: HAProxy\nCurrConns: 3\n',
+    'show stat -1 6 -1': '# pxname,svname,scur,type,\nhttp_in,FRONTEND,4,0,\nhttp_out,BACKEND,2,1,\n',
+    'show resolvers': 'Resolvers section mydns\n nameserver dns1:\n  sent:        8\n\n'
+                      'Resolvers section mydns2\n nameserver dns2:\n  sent:        2\n',
+}
+
+
+def test_batch_sends_all_commands_in_one_write():
+    fake_socket = FakeSocket(BATCH_RESPONSES)
+    haproxy_socket = haproxy.HAProxySocket('/var/run/haproxy.sock')
+    haproxy_socket.connect = MagicMock(return_value=fake_socket)
+    server_info, server_stats, resolvers = haproxy_socket.get_all_stats(proxy_types=6)
+    assert fake_socket.sent == ['show info;show stat -1 6 -1;show resolvers\n']
+    assert server_info == {'Name': 'HAProxy', 'CurrConns': '3'}
+    assert [(row['pxname'], row['svname'], row['scur']) for row in server_stats] == \
+        [('http_in', 'FRONTEND', '4'), ('http_out', 'BACKEND', '2')]
+    assert resolvers == {'dns1': {'sent': '8'}, 'dns2': {'sent': '2'}}
+
+
+def test_batch_splits_empty_responses():
+    fake_socket = FakeSocket({'show stat': '# pxname,svname,\n'})
+    haproxy_socket = haproxy.HAProxySocket('/var/run/haproxy.sock')
+    haproxy_socket.connect = MagicMock(return_value=fake_socket)
+    assert haproxy_socket.communicate_batch(['show info', 'show stat', 'show resolvers']) == \
+        ['', '# pxname,svname,\n', '\n']
+
+
+def test_batch_is_pipelined_over_persistent_session():
+    fake_socket = FakePromptSocket(BATCH_RESPONSES)
+    haproxy_socket = haproxy.HAProxySocket('/var/run/haproxy.sock', persistent=True)
+    haproxy_socket.connect = MagicMock(return_value=fake_socket)
+    server_info, server_stats, resolvers = haproxy_socket.get_all_stats(proxy_types=6)
+    assert fake_socket.commands == ['prompt', 'show info', 'show stat -1 6 -1', 'show resolvers']
+    assert server_info == {'Name': 'HAProxy', 'CurrConns': '3'}
+    assert resolvers == {'dns1': {'sent': '8'}, 'dns2': {'sent': '2'}}
+
+
+def test_server_stats_are_read_by_column_name():
+    haproxy_socket = haproxy.HAProxySocket('/var/run/haproxy.sock')
+    haproxy_socket.connect = MagicMock(return_value=FakeSocket({'show stat': '# pxname,svname,status,scur,type,check_desc,\n'
+                                                                              'web,FRONTEND,OPEN,4,0,,\n'
+                                                                              'web,srv1,UP,2,2,"Layer4 check, passed",\n'}))
+    frontend, server = haproxy_socket.get_server_stats()
+    assert (frontend['pxname'], frontend['svname'], frontend['type']) == ('web', 'FRONTEND', '0')
+    assert server['check_desc'] == 'Layer4 check, passed'
+    assert server.items() == [('scur', '2')]
+    assert 'status' in server and 'bin' not in server
+
+    # the same columns in another order, as emitted by a different HAProxy version
+    haproxy_socket.connect = MagicMock(return_value=FakeSocket({'show stat': '# type,scur,svname,pxname,\n2,2,srv1,web,\n'}))
+    server, = haproxy_socket.get_server_stats()
+    assert (server['pxname'], server['svname'], server['type']) == ('web', 'srv1', '2')
+    assert server.items() == [('scur', '2')]
+
+
+def test_large_responses_are_read_with_growing_reads():
+    stat_output = '# pxname,svname,scur,\n' + ''.join('px%d,srv%d,%d,\n' % (i, i, i) for i in range(20000))
+    fake_socket = FakeSocket({'show stat': stat_output})
+    fake_socket.recv = MagicMock(wraps=fake_socket.recv)
+    haproxy_socket = haproxy.HAProxySocket('/var/run/haproxy.sock')
+    haproxy_socket.connect = MagicMock(return_value=fake_socket)
+    assert haproxy_socket.communicate('show stat') == stat_output + '\n'
+    assert fake_socket.recv.call_count < 20
+    assert haproxy_socket._buffer.recv_size == haproxy.MAX_RECV_SIZE
+
+
+def test_prompt_split_across_reads_is_found():
+    fake_socket = FakePromptSocket({'show info': 'Uptime_sec: 10\n' * 2000})
+    haproxy_socket = haproxy.HAProxySocket('/var/run/haproxy.sock', persistent=True)
+    haproxy_socket.connect = MagicMock(return_value=fake_socket)
+    for _ in range(3):
+        assert haproxy_socket.communicate_batch(['show info', 'show info']) == ['Uptime_sec: 10\n' * 2000 + '\n'] * 2
+
+
+def test_server_stats_are_streamed_off_the_socket():
+    stat_output = '# pxname,svname,scur,type,\n' + ''.join('px%d,FRONTEND,%d,0,\n' % (i, i) for i in range(20000))
+    fake_socket = FakeSocket({'show stat': stat_output})
+    fake_socket.recv = MagicMock(wraps=fake_socket.recv)
+    haproxy_socket = haproxy.HAProxySocket('/var/run/haproxy.sock')
+    haproxy_socket.connect = MagicMock(return_value=fake_socket)
+    rows = haproxy_socket.get_server_stats()
+    assert next(rows)['pxname'] == 'px0'
+    assert fake_socket.recv.call_count == 1
+    assert sum(1 for _ in rows) == 19999
+    assert len(haproxy_socket._buffer.data) <= 2 * haproxy.MAX_RECV_SIZE
+
+
+def test_server_stats_are_streamed_over_persistent_session():
+    fake_socket = FakePromptSocket({'show stat': '# pxname,svname,scur,type,\nweb,FRONTEND,4,0,\n', 'show info': 'Pid: 1\n'})
+    haproxy_socket = haproxy.HAProxySocket('/var/run/haproxy.sock', persistent=True)
+    haproxy_socket.connect = MagicMock(return_value=fake_socket)
+    assert [row['scur'] for row in haproxy_socket.get_server_stats()] == ['4']
+    assert haproxy_socket.get_server_info() == {'Pid': '1'}
+    assert haproxy_socket.connect.call_count == 1
+
+
+def test_metrics_submitted_from_socket_output():
+    haproxy.submit_metrics = MagicMock()
+    mock_config = Mock()
+    mock_config.children = [
+        ConfigOption('ProxyMonitor', ('backend',)),
+        ConfigOption('Testing', ('True',))
+    ]
+    module_config = haproxy.config(mock_config)
+    with patch('haproxy.HAProxySocket.connect', side_effect=lambda: FakeSocket(BATCH_RESPONSES)):
+        haproxy.collect_metrics(module_config)
+    haproxy.submit_metrics.assert_has_calls([
+        call({'values': (3,), 'type_instance': 'currconns', 'type': 'gauge', 'plugin': 'haproxy'}),
+        call({'values': (2,), 'plugin_instance': 'backend.http_out', 'type_instance': 'scur', 'type': 'gauge',
+              'plugin': 'haproxy'}),
+        call({'values': (2,), 'plugin_instance': 'nameserver.dns2', 'type_instance': 'sent', 'type': 'gauge',
+              'plugin': 'haproxy'}),
+        call({'values': (8,), 'plugin_instance': 'nameserver.dns1', 'type_instance': 'sent', 'type': 'gauge',
+              'plugin': 'haproxy'})])
+
+
+def test_proxy_monitors_are_translated_to_show_stat_filter():
+    assert haproxy._get_proxy_type_filter(['frontend']) == 1
+    assert haproxy._get_proxy_type_filter(['Backend']) == 6
+    assert haproxy._get_proxy_type_filter(['server', 'frontend', 'backend']) == 7
+    assert haproxy._get_proxy_type_filter(['frontend', 'elasticsearch_backend']) == -1
+
+    haproxy_socket = haproxy.HAProxySocket('/var/run/haproxy.sock')
+    fake_socket = FakeSocket({'show stat -1 1 -1': '# pxname,svname,\nweb,FRONTEND,\n'})
+    haproxy_socket.connect = MagicMock(return_value=fake_socket)
+    assert [row['pxname'] for row in haproxy_socket.get_server_stats(proxy_types=1)] == ['web']
+    assert fake_socket.sent == ['show stat -1 1 -1\n']
+
+
+class MockHAProxySocketPerProcess(object):
+    def __init__(self, socket_file="whatever"):
+        self.socket_file = socket_file
+        self.process = int(socket_file[-len('1.sock'):-len('.sock')])
+
+    def get_resolvers(self):
+        return {}
+
+    def get_server_info(self):
+        time.sleep(0.2)
+        return {'CurrConns': str(self.process), 'Uptime_sec': str(100 + self.process)}
+
+    def get_server_stats(self, proxy_types=-1):
+        return [{'pxname': 'web', 'svname': 'FRONTEND', 'type': '0', 'stot': str(10 * self.process),
+                 'smax': str(self.process)}]
+
+
+def per_process_config(*extra_options):
+    mock_config = Mock()
+    mock_config.children = [
+        ConfigOption('Socket', ('/run/haproxy1.sock', '/run/haproxy2.sock', '/run/haproxy3.sock')),
+        ConfigOption('ProxyMonitor', ('frontend',)),
+        ConfigOption('Testing', ('True',))
+    ] + list(extra_options)
+    return haproxy.config(mock_config)
+
+
+@patch('haproxy.HAProxySocket', MockHAProxySocketPerProcess)
+def test_multiple_sockets_are_collected_concurrently_per_process():
+    haproxy.submit_metrics = MagicMock()
+    start = time.time()
+    haproxy.collect_metrics(per_process_config())
+    assert time.time() - start < 0.5
+    submitted = [(c[0][0].get('plugin_instance'), c[0][0]['type_instance'], c[0][0]['values'])
+                 for c in haproxy.submit_metrics.call_args_list]
+    for process in (1, 2, 3):
+        assert ('process.%d' % process, 'currconns', (process,)) in submitted
+        assert ('process.%d.frontend.web' % process, 'stot', (10 * process,)) in submitted
+
+
+@patch('haproxy.HAProxySocket', MockHAProxySocketPerProcess)
+def test_multiple_sockets_are_aggregated_across_processes():
+    haproxy.submit_metrics = MagicMock()
+    haproxy.collect_metrics(per_process_config(ConfigOption('AggregateProcesses', ('true',)),
+                                               ConfigOption('MaxWorkers', ('2',))))
+    submitted = sorted((c[0][0].get('plugin_instance'), c[0][0]['type_instance'], c[0][0]['values'])
+                       for c in haproxy.submit_metrics.call_args_list)
+    assert submitted == [(None, 'currconns', (6,)), (None, 'uptime_sec', (103,)),
+                         ('frontend.web', 'smax', (3,)), ('frontend.web', 'stot', (60,))]
+
+
+class MockHAProxySocketPerProcessWithTables(MockHAProxySocketPerProcess):
+    def get_server_info(self):
+        return {'CurrConns': str(self.process)}
+
+    def get_tables(self):
+        return [{'table': 'rl', 'type': 'ip', 'size': 1024, 'used': self.process}]
+
+
+@patch('haproxy.HAProxySocket', MockHAProxySocketPerProcessWithTables)
+def test_stick_tables_are_collected_per_process_of_multiple_sockets():
+    for extra_options in ((), (ConfigOption('AggregateProcesses', ('true',)),)):
+        haproxy.submit_metrics = MagicMock()
+        haproxy.collect_metrics(per_process_config(ConfigOption('StickTables', ('true',)), *extra_options))
+        submitted = [(c[0][0].get('plugin_instance'), c[0][0]['type_instance'], c[0][0]['values'])
+                     for c in haproxy.submit_metrics.call_args_list]
+        # each process has tables of its own, so they aren't summed with AggregateProcesses either
+        for process in (1, 2, 3):
+            assert ('process.%d.table.rl' % process, 'size', (1024,)) in submitted
+            assert ('process.%d.table.rl' % process, 'used', (process,)) in submitted
+
+
+class MockHAProxySocketPerProcessWithInternals(MockHAProxySocketPerProcessWithTables):
+    def get_activity(self):
+        return collections.OrderedDict([('loops', (100 * self.process, [10 * self.process]))])
+
+
+@patch('haproxy.HAProxySocket', MockHAProxySocketPerProcessWithInternals)
+def test_internals_are_collected_per_process_of_multiple_sockets():
+    for extra_options in ((), (ConfigOption('AggregateProcesses', ('true',)),)):
+        haproxy.submit_metrics = MagicMock()
+        haproxy.collect_metrics(per_process_config(ConfigOption('ActivityMetrics', ('true',)), *extra_options))
+        submitted = [(c[0][0].get('plugin_instance'), c[0][0]['type_instance'], c[0][0]['values'])
+                     for c in haproxy.submit_metrics.call_args_list]
+        for process in (1, 2, 3):
+            assert ('process.%d.activity' % process, 'loops', (100 * process,)) in submitted
+            assert ('process.%d.activity.thread.1' % process, 'loops', (10 * process,)) in submitted
+
+
+def test_master_socket_warns_about_sources_it_does_not_collect():
+    mock_config = Mock()
+    mock_config.children = [
+        ConfigOption('MasterSocket', ('true',)),
+        ConfigOption('PoolMetrics', ('true',)),
+        ConfigOption('Testing', ('True',))
+    ]
+    with patch.object(haproxy.collectd, 'warning') as warning:
+        haproxy.config(mock_config)
+    assert warning.call_count == 1 and 'not collected through a MasterSocket' in warning.call_args[0][0]
+
+
+SHOW_PROC = """#<PID>          <type>          <relative PID>  <reloads>       <uptime>        <version>
+1162            master          0               5               0d00h02m07s     2.4.0
+# workers
+1271            worker          1               0               0d00h00m00s     2.4.0
+1272            worker          2               0               0d00h00m00s     2.4.0
+# old workers
+1233            worker          [was: 1]        3               0d00h00m55s     2.4.0
+# programs
+"""
+
+# HAProxy 2.5 and later have no <relative PID> column
+SHOW_PROC_2_5 = """#<PID>          <type>          <reloads>       <uptime>        <version>
+1162            master          5 [failed: 0]   0d00h02m07s     2.5.0
+# workers
+1271            worker          0               0d00h00m00s     2.5.0
+1272            worker          0               0d00h00m00s     2.5.0
+# old workers
+1233            worker          3               0d00h00m55s     2.5.0
+# programs
+1244            sidecar         0               0d00h02m07s     -
+"""
+
+
+def test_workers_are_parsed_from_show_proc_of_every_layout():
+    assert haproxy._parse_workers(SHOW_PROC) == [('1', '1271'), ('2', '1272')]
+    assert haproxy._parse_workers(SHOW_PROC_2_5) == [('1', '1271'), ('2', '1272')]
+
+
+def master_responses():
+    responses = {'show proc': SHOW_PROC}
+    for relative_pid, pid in (('1', '1271'), ('2', '1272')):
+        responses['@!%s show info' % pid] = 'Pid: %s\nCurrConns: %s\n' % (pid, relative_pid)
+        responses['@!%s show stat -1 1 -1' % pid] = '# pxname,svname,scur,type,\nweb,FRONTEND,%s,0,\n' % relative_pid
+        responses['@!%s show resolvers' % pid] = ''
+    return responses
+
+
+def test_worker_stats_are_routed_through_master_session():
+    fake_socket = FakePromptSocket(master_responses(), prompt='master> ')
+    haproxy_socket = haproxy.HAProxySocket('/var/run/haproxy-master.sock', master=True)
+    haproxy_socket.connect = MagicMock(return_value=fake_socket)
+    assert haproxy_socket.get_workers() == [('1', '1271'), ('2', '1272')]
+    worker_stats = haproxy_socket.get_worker_stats(proxy_types=1)
+    assert haproxy_socket.connect.call_count == 1
+    assert [(relative_pid, info['Pid'], [row['scur'] for row in stats], resolvers)
+            for relative_pid, info, stats, resolvers in worker_stats] == [('1', '1271', ['1'], {}),
+                                                                           ('2', '1272', ['2'], {})]
+
+
+def test_metrics_submitted_per_worker_from_master_socket():
+    haproxy.submit_metrics = MagicMock()
+    mock_config = Mock()
+    mock_config.children = [
+        ConfigOption('Socket', ('/var/run/haproxy-master.sock',)),
+        ConfigOption('MasterSocket', ('true',)),
+        ConfigOption('ProxyMonitor', ('frontend',)),
+        ConfigOption('Testing', ('True',))
+    ]
+    module_config = haproxy.config(mock_config)
+    with patch('haproxy.HAProxySocket.connect', return_value=FakePromptSocket(master_responses(), prompt='master> ')):
+        haproxy.collect_metrics(module_config)
+    submitted = [(c[0][0].get('plugin_instance'), c[0][0]['type_instance'], c[0][0]['values'])
+                 for c in haproxy.submit_metrics.call_args_list]
+    assert submitted == [('process.1', 'currconns', (1,)), ('process.1.frontend.web', 'scur', (1,)),
+                         ('process.2', 'currconns', (2,)), ('process.2.frontend.web', 'scur', (2,))]
+
+
+def test_master_socket_errors_are_counted_by_self_metrics():
+    submitted = []
+    haproxy.submit_metrics = MagicMock(side_effect=lambda entry: submitted.append(
+        (entry.get('plugin_instance'), entry['type_instance'], entry['values'][0])))
+    mock_config = Mock()
+    mock_config.children = [
+        ConfigOption('Socket', ('/var/run/haproxy-master.sock',)),
+        ConfigOption('MasterSocket', ('true',)),
+        ConfigOption('SelfMetrics', ('true',)),
+        ConfigOption('Testing', ('True',))
+    ]
+    module_config = haproxy.config(mock_config)
+    with patch('haproxy.HAProxySocket.connect', side_effect=socket.error('Connection refused')):
+        haproxy.collect_metrics(module_config)
+    assert ('collector', 'errors', 1) in submitted
+
+
+def test_wedged_haproxy_times_out_and_discards_partial_result():
+    socket_dir = tempfile.mkdtemp()
+    socket_file = os.path.join(socket_dir, 'haproxy.sock')
+    # accepts connections through its backlog but never answers
+    wedged_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    wedged_socket.bind(socket_file)
+    wedged_socket.listen(5)
+    try:
+        haproxy.submit_metrics = MagicMock()
+        mock_config = Mock()
+        mock_config.children = [
+            ConfigOption('Socket', (socket_file,)),
+            ConfigOption('Timeout', ('0.2',)),
+            ConfigOption('Testing', ('True',))
+        ]
+        module_config = haproxy.config(mock_config)
+        start = time.time()
+        haproxy.collect_metrics(module_config)
+        assert time.time() - start < 1
+        assert module_config['timeouts'] == 1
+        haproxy.submit_metrics.assert_called_once_with({'values': (1,), 'plugin_instance': 'collector',
+                                                        'type_instance': 'timeouts', 'type': 'derive',
+                                                        'plugin': 'haproxy'})
+    finally:
+        wedged_socket.close()
+        shutil.rmtree(socket_dir)
+
+
+def test_timeout_discards_stats_read_before_deadline():
+    haproxy_socket = haproxy.HAProxySocket('/var/run/haproxy.sock')
+    haproxy_socket.get_server_info = MagicMock(return_value={'CurrConns': '1'})
+    haproxy_socket.get_server_stats = MagicMock(side_effect=haproxy.CollectionTimeout())
+    mock_config = Mock()
+    mock_config.children = [
+        ConfigOption('Timeout', ('5',)),
+        ConfigOption('Testing', ('True',))
+    ]
+    module_config = haproxy.config(mock_config)
+    module_config['haproxy_sockets'] = {'/var/run/haproxy.sock': haproxy_socket}
+    assert list(haproxy.get_stats(module_config)) == []
+    assert module_config['timeouts'] == 1
+    assert haproxy_socket.deadline > time.time()
+
+
+def background_config(*extra_options):
+    mock_config = Mock()
+    mock_config.children = [
+        ConfigOption('BackgroundPolling', ('true',)),
+        ConfigOption('Testing', ('True',))
+    ] + list(extra_options)
+    return haproxy.config(mock_config)
+
+
+@patch('haproxy.HAProxySocket', MockHAProxySocketSimple)
+def test_background_poller_snapshot_is_dispatched():
+    haproxy.submit_metrics = MagicMock()
+    module_config = background_config(ConfigOption('PollInterval', ('0.05',)))
+    poller = module_config['poller']
+    try:
+        haproxy.collect_metrics(module_config)
+        for _ in range(100):
+            if poller.latest is not None:
+                break
+            time.sleep(0.01)
+        haproxy.collect_metrics(module_config)
+    finally:
+        poller.stop()
+        poller._thread.join(1)
+    assert not poller._thread.is_alive()
+    assert abs(module_config['stale_after'] - 0.15) < 1e-9
+    submitted = [(c[0][0].get('plugin_instance'), c[0][0]['type_instance']) for c in haproxy.submit_metrics.call_args_list]
+    assert ('collector', 'snapshot_age') in submitted
+    assert (None, 'cumreq') in submitted
+    assert ('frontend.sample_proxy', 'bout') in submitted
+
+
+def test_stale_background_snapshot_is_not_dispatched():
+    haproxy.submit_metrics = MagicMock()
+    module_config = background_config(ConfigOption('StaleAfter', ('30',)))
+    poller = module_config['poller']
+    poller.start = MagicMock()
+    poller.latest = (time.time() - 60, (('CumReq', 5, {}),))
+    haproxy.collect_metrics(module_config)
+    assert [c[0][0]['type_instance'] for c in haproxy.submit_metrics.call_args_list] == ['snapshot_age']
+    poller.latest = (time.time() - 10, (('CumReq', 5, {}),))
+    haproxy.collect_metrics(module_config)
+    assert [c[0][0]['type_instance'] for c in haproxy.submit_metrics.call_args_list][-1] == 'cumreq'
+
+
+def test_dispatch_plan_reuses_series_across_intervals():
+    plan = haproxy.DispatchPlan()
+    row = {'pxname': 'web', 'svname': 'FRONTEND', 'type': '0'}
+    entry = plan.get_entry('scur', row)
+    assert plan.get_datapoint(entry, (1,)) == {'plugin': 'haproxy', 'type': 'gauge', 'type_instance': 'scur',
+                                               'plugin_instance': 'frontend.web', 'values': (1,)}
+    assert plan.get_entry('status', row) is None
+    series = plan._last_series
+    plan.end_collection()
+
+    assert plan.get_entry('scur', dict(row)) is entry
+    assert plan._last_series is series
+    assert plan.get_entry('CurrConns', {}) is not None
+    plan.end_collection()
+    # the frontend is gone after a reload
+    plan.get_entry('CurrConns', {})
+    plan.end_collection()
+    plan.get_entry('scur', row)
+    assert plan._last_series is not series
+
+
+def test_dispatch_plan_suppresses_unchanged_gauges_between_heartbeats():
+    plan = haproxy.DispatchPlan(heartbeat_intervals=3)
+    row = {'pxname': 'web', 'svname': 'BACKEND', 'type': '1'}
+    sent = []
+    for value in (4, 4, 4, 4, 5, 5):
+        gauge = plan.get_entry('act', row)
+        derive = plan.get_entry('stot', row)
+        sent.append((plan.should_dispatch(gauge, value), plan.should_dispatch(derive, 7)))
+        plan.end_collection()
+    assert sent == [(True, True), (False, True), (False, True), (True, True), (True, True), (False, True)]
+
+    plan.get_entry('act', row)
+    assert not plan.should_dispatch(plan.get_entry('act', row), 5)
+    assert plan.suppressed == 1
+    # the last values are kept per series
+    assert plan.should_dispatch(plan.get_entry('act', {'pxname': 'api', 'svname': 'BACKEND', 'type': '1'}), 5)
+    assert list(plan._last_series.last_values) == [5]
+
+
+def test_submit_metrics_shares_one_values():
+    values_class = haproxy.collectd.Values
+    haproxy.collectd.Values = MagicMock()
+    dispatch = haproxy.DISPATCH_VALUES.dispatch
+    haproxy.DISPATCH_VALUES.dispatch = MagicMock()
+    try:
+        for value in (1, 2):
+            submit_metrics({'plugin': 'haproxy', 'type': 'gauge', 'type_instance': 'scur',
+                            'plugin_instance': 'frontend.web', 'values': (value,)})
+        submit_metrics({'plugin': 'haproxy', 'type': 'gauge', 'type_instance': 'connrate', 'values': (3,)})
+        assert not haproxy.collectd.Values.called
+        haproxy.DISPATCH_VALUES.dispatch.assert_has_calls([
+            call(plugin='haproxy', plugin_instance='frontend.web', type='gauge', type_instance='scur', values=(1,)),
+            call(plugin='haproxy', plugin_instance='frontend.web', type='gauge', type_instance='scur', values=(2,)),
+            call(plugin='haproxy', plugin_instance='', type='gauge', type_instance='connrate', values=(3,))])
+    finally:
+        haproxy.collectd.Values = values_class
+        haproxy.DISPATCH_VALUES.dispatch = dispatch
+
+
+TYPED_RESPONSES = {
+    'show info typed': '0.Name.1:POS:str:HAProxy\n1.Version.1:POS:str:1.8.14\n33.CurrConns.1:CGP:u32:3\n'
+                       '5.Uptime_sec.1:MDP:u32:1200\n',
+    'show stat -1 6 -1 typed': 'B.3.0.0.pxname.1:KNSV:str:web\nB.3.0.1.svname.1:KNSV:str:BACKEND\n'
+                               'B.3.0.4.scur.1:MGP:u32:5\nB.3.0.17.status.1:SGP:str:UP\n'
+                               'S.3.1.0.pxname.1:KNSV:str:web\nS.3.1.1.svname.1:KNSV:str:srv1\n'
+                               'S.3.1.4.scur.1:MGP:u32:2\nS.3.1.5.qmax.1:MGP:u32:\n',
+}
+
+
+def test_typed_output_is_parsed_by_field_type():
+    haproxy_socket = haproxy.HAProxySocket('/var/run/haproxy.sock', typed=True)
+    haproxy_socket.connect = MagicMock(side_effect=lambda: FakeSocket(TYPED_RESPONSES))
+    assert haproxy_socket.get_server_info() == {'Name': 'HAProxy', 'Version': '1.8.14', 'CurrConns': 3,
+                                                'Uptime_sec': 1200}
+    assert list(haproxy_socket.get_server_stats(proxy_types=6)) == [
+        {'type': '1', 'pxname': 'web', 'svname': 'BACKEND', 'scur': 5},
+        {'type': '2', 'pxname': 'web', 'svname': 'srv1', 'scur': 2, 'qmax': ''}]
+    assert haproxy_socket.typed
+
+
+def test_typed_output_falls_back_to_csv_when_unsupported():
+    responses = dict(BATCH_RESPONSES)
+    responses['show info typed'] = 'Unknown command. Please enter one of the following commands only :\n'
+    haproxy_socket = haproxy.HAProxySocket('/var/run/haproxy.sock', typed=True)
+    haproxy_socket.connect = MagicMock(side_effect=lambda: FakeSocket(responses))
+    assert haproxy_socket.get_server_info() == {'Name': 'HAProxy', 'CurrConns': '3'}
+    assert not haproxy_socket.typed
+    assert [row['svname'] for row in haproxy_socket.get_server_stats(proxy_types=6)] == ['FRONTEND', 'BACKEND']
+
+
+def test_empty_typed_replies_keep_typed_output_on():
+    haproxy_socket = haproxy.HAProxySocket('/var/run/haproxy.sock', typed=True)
+    # no rows match the filter, and HAProxy closes the connection without answering show info
+    fake_socket = FakeSocket({'show stat -1 1 -1 typed': ''})
+    haproxy_socket.connect = MagicMock(return_value=fake_socket)
+    with patch.object(haproxy.collectd, 'warning') as warning:
+        assert list(haproxy_socket.get_server_stats(proxy_types=1)) == []
+        assert haproxy_socket.get_server_info() == {}
+    assert haproxy_socket.typed
+    assert not warning.called
+    assert fake_socket.sent == ['show stat -1 1 -1 typed\n', 'show info typed\n']
+
+
+def test_only_collected_columns_are_converted():
+    stats = list(haproxy._iter_server_stats_stats([{'pxname': 'web', 'svname': 'BACKEND', 'type': '1', 'scur': '4',
+                                                   'qmax': '', 'slim': None, 'iid': '3', 'throttle': '-1',
+                                                   'status': 'UP', 'weight': 'x'}],
+                                                 {'proxy_monitors': ['backend'],
+                                                  'metric_selection': haproxy.MetricSelection(haproxy.METRICS_TO_COLLECT)}))
+    assert sorted((name, value) for name, value, _ in stats) == [('scur', 4), ('throttle', -1)]
+
+
+def test_metric_selection_is_compiled_from_tiers_and_globs():
+    basic = haproxy._compile_metric_selection(False, set(), set())
+    assert 'scur' in basic.converters and 'comp_in' not in basic.converters
+    enhanced = haproxy._compile_metric_selection(True, set(), set(['hrsp_*', 'MAX*']))
+    assert 'comp_in' in enhanced.converters and 'MaxConn' not in enhanced.converters
+    assert not [name for name in enhanced.converters if name.startswith('hrsp_')]
+    included = haproxy._compile_metric_selection(False, set(['comp_*']), set(['comp_byp']))
+    assert 'comp_in' in included.converters and 'comp_byp' not in included.converters
+
+
+def test_default_selection_is_the_basic_tier():
+    selection = haproxy.config(mock_config_default_values)['metric_selection']
+    assert set(selection.converters) == haproxy.BASIC_METRICS
+    # left out by default since the basic tier was introduced, see Upgrading in README.md
+    assert sorted(set(haproxy.METRICS_TO_COLLECT) - haproxy.BASIC_METRICS, key=str.lower) == [
+        'check_duration', 'comp_byp', 'comp_in', 'comp_out', 'comp_rsp', 'CompressBpsIn', 'CompressBpsOut',
+        'conn_rate', 'conn_rate_max', 'conn_tot', 'CumSslConns', 'dcon', 'dses', 'intercepted', 'lastsess',
+        'MaxConnRate', 'MaxPipes', 'MaxSessRate', 'MaxSslConns', 'PipesFree', 'PipesUsed', 'qlimit', 'rate_lim',
+        'rate_max', 'req_rate_max', 'SslBackendKeyRate', 'SslCacheLookups', 'SslCacheMisses', 'SslFrontendKeyRate',
+        'throttle', 'ZlibMemUsage']
+
+
+def test_unselected_columns_are_not_dispatched():
+    haproxy.submit_metrics = MagicMock()
+    mock_config = Mock()
+    mock_config.children = [
+        ConfigOption('ProxyMonitor', ('backend',)),
+        ConfigOption('IncludeMetric', ('rate_max',)),
+        ConfigOption('ExcludeMetric', ('*',)),
+        ConfigOption('Testing', ('True',))
+    ]
+    module_config = haproxy.config(mock_config)
+    haproxy_socket = haproxy.HAProxySocket('/var/run/haproxy.sock')
+    haproxy_socket.connect = MagicMock(return_value=FakeSocket({
+        'show info': 'CurrConns: 3\n',
+        'show stat -1 6 -1': '# pxname,svname,scur,rate_max,type,\nweb,BACKEND,1,9,1,\n'}))
+    module_config['haproxy_sockets'] = {'/var/run/haproxy.sock': haproxy_socket}
+    haproxy.collect_metrics(module_config)
+    assert not haproxy.submit_metrics.called
+
+    module_config['metric_selection'] = haproxy._compile_metric_selection(False, set(['rate_max']), set(['scur']))
+    haproxy_socket.connect.return_value = FakeSocket({
+        'show info': 'CurrConns: 3\n',
+        'show stat -1 6 -1': '# pxname,svname,scur,rate_max,type,\nweb,BACKEND,1,9,1,\n'})
+    haproxy.collect_metrics(module_config)
+    submitted = [(c[0][0].get('plugin_instance'), c[0][0]['type_instance']) for c in haproxy.submit_metrics.call_args_list]
+    assert submitted == [(None, 'currconns'), ('backend.web', 'rate_max')]
+
+
+def test_server_columns_are_aggregated_per_backend():
+    haproxy.submit_metrics = MagicMock()
+    mock_config = Mock()
+    mock_config.children = [
+        ConfigOption('ProxyMonitor', ('backend', 'server')),
+        ConfigOption('AggregateServerMetric', ('scur', 'qcur')),
+        ConfigOption('AggregateServerPercentiles', ('True',)),
+        ConfigOption('DropServerMetrics', ('True',)),
+        ConfigOption('Testing', ('True',))
+    ]
+    module_config = haproxy.config(mock_config)
+    haproxy_socket = haproxy.HAProxySocket('/var/run/haproxy.sock')
+    haproxy_socket.connect = MagicMock(return_value=FakeSocket({
+        'show info': '',
+        'show stat -1 6 -1': '# pxname,svname,qcur,scur,type,\nweb,s1,0,1,2,\nweb,s2,0,4,2,\nweb,s3,0,7,2,\n'
+                             'web,BACKEND,0,12,1,\n'}))
+    module_config['haproxy_sockets'] = {'/var/run/haproxy.sock': haproxy_socket}
+    haproxy.collect_metrics(module_config)
+
+    submitted = dict(((c[0][0]['plugin_instance'], c[0][0]['type_instance']), (c[0][0]['type'], c[0][0]['values']))
+                     for c in haproxy.submit_metrics.call_args_list)
+    assert not [key for key in submitted if key[0].startswith('backend.web.s')]
+    assert submitted[('backend.web', 'scur')] == ('gauge', (12,))
+    assert submitted[('servers.web', 'scur_sum')] == ('gauge', (12,))
+    assert submitted[('servers.web', 'scur_min')] == ('gauge', (1,))
+    assert submitted[('servers.web', 'scur_max')] == ('gauge', (7,))
+    assert submitted[('servers.web', 'scur_mean')] == ('gauge', (4.0,))
+    assert submitted[('servers.web', 'scur_p50')] == ('gauge', (4,))
+    assert submitted[('servers.web', 'scur_p95')] == ('gauge', (7,))
+    assert submitted[('servers.web', 'qcur_sum')] == ('gauge', (0,))
+
+
+def test_unknown_aggregated_and_burst_metrics_are_warned_about():
+    mock_config = Mock()
+    mock_config.children = [
+        ConfigOption('AggregateServerMetric', ('scur', 'sucr')),
+        ConfigOption('BurstMetric', ('qcru',)),
+        ConfigOption('Testing', ('True',))
+    ]
+    with patch.object(haproxy.collectd, 'warning') as warning:
+        module_config = haproxy.config(mock_config)
+    assert module_config['server_aggregation'].metric_names == frozenset(['scur'])
+    warning.assert_has_calls([call('haproxy: Ignoring unknown AggregateServerMetric metrics: sucr'),
+                              call('haproxy: Ignoring unknown BurstMetric metrics: qcru')])
+
+
+def test_burst_sampler_rolls_up_samples_between_collections():
+    mock_config = Mock()
+    mock_config.children = [
+        ConfigOption('ProxyMonitor', ('backend',)),
+        ConfigOption('BurstMetric', ('qcur',)),
+        ConfigOption('BurstSampleInterval', ('0.1',)),
+        ConfigOption('Testing', ('True',))
+    ]
+    module_config = haproxy.config(mock_config)
+    sampler = module_config['burst_sampler']
+    haproxy_socket = haproxy.HAProxySocket('/var/run/haproxy.sock')
+    sampler._sockets['/var/run/haproxy.sock'] = haproxy_socket
+    for qcur in (2, 9, 4):
+        haproxy_socket.connect = MagicMock(return_value=FakeSocket({
+            'show stat -1 6 -1': '# pxname,svname,qcur,scur,type,\nweb,BACKEND,%d,1,1,\n' % qcur}))
+        sampler.sample()
+
+    stats = sampler.drain()
+    assert [(name, value, dimensions['burst']) for name, value, dimensions in stats] == [
+        ('qcur', 9, 'max'), ('qcur', 5, 'avg'), ('qcur', 4, 'last')]
+    plan = haproxy.DispatchPlan()
+    datapoint = plan.get_datapoint(plan.get_entry(*stats[1][::2]), (5,))
+    assert (datapoint['plugin_instance'], datapoint['type_instance']) == ('backend.web', 'qcur_burst_avg')
+    assert sampler.drain() == []
+
+
+def test_burst_sampler_warns_once_per_failing_socket():
+    mock_config = Mock()
+    mock_config.children = [
+        ConfigOption('Socket', ('/run/haproxy1.sock', '/run/haproxy2.sock')),
+        ConfigOption('BurstMetric', ('qcur',)),
+        ConfigOption('Testing', ('True',))
+    ]
+    module_config = haproxy.config(mock_config)
+    sampler = module_config['burst_sampler']
+    for socket_file in module_config['sockets']:
+        sampler._sockets[socket_file] = haproxy.HAProxySocket(socket_file)
+    sampler._sockets['/run/haproxy1.sock'].connect = MagicMock(side_effect=socket.error('Connection refused'))
+    sampler._sockets['/run/haproxy2.sock'].connect = MagicMock(side_effect=lambda: FakeSocket({
+        haproxy._stat_command(module_config['proxy_types']): '# pxname,svname,qcur,type,\nweb,BACKEND,1,1,\n'}))
+    with patch.object(haproxy.collectd, 'warning') as warning:
+        for _ in range(5):
+            sampler.sample()
+    warning.assert_called_once_with(
+        'haproxy: Sampling HAProxy socket at /run/haproxy1.sock failed: Connection refused')
+    assert [(name, dimensions['process']) for name, _, dimensions in sampler.drain()] == [('qcur', '2')] * 3
+
+
+def test_sources_are_fetched_at_their_own_interval():
+    submitted = []
+    haproxy.submit_metrics = MagicMock(side_effect=lambda entry: submitted.append(
+        (entry['type_instance'], entry['values'])))
+    mock_config = Mock()
+    mock_config.children = [
+        ConfigOption('ProxyMonitor', ('backend',)),
+        ConfigOption('InfoInterval', ('60',)),
+        ConfigOption('ResolversInterval', ('60',)),
+        ConfigOption('PipelineCommands', ('True',)),
+        ConfigOption('Testing', ('True',))
+    ]
+    module_config = haproxy.config(mock_config)
+    haproxy_socket = haproxy.HAProxySocket('/var/run/haproxy.sock')
+    haproxy_socket.get_all_stats = MagicMock(return_value=(
+        {'CurrConns': '3'}, iter([{'pxname': 'web', 'svname': 'BACKEND', 'type': '1', 'scur': '1'}]),
+        {'dns1': {'sent': '8'}}))
+    haproxy_socket.get_server_stats = MagicMock(
+        return_value=iter([{'pxname': 'web', 'svname': 'BACKEND', 'type': '1', 'scur': '2'}]))
+    haproxy_socket.get_server_info = MagicMock()
+    haproxy_socket.get_resolvers = MagicMock()
+    module_config['haproxy_sockets'] = {'/var/run/haproxy.sock': haproxy_socket}
+
+    haproxy.collect_metrics(module_config)
+    haproxy.collect_metrics(module_config)
+    assert haproxy_socket.get_all_stats.call_count == 1
+    assert haproxy_socket.get_server_stats.call_count == 1
+    assert not haproxy_socket.get_server_info.called and not haproxy_socket.get_resolvers.called
+    assert submitted == [('currconns', (3,)), ('scur', (1,)), ('sent', (8,)),
+                         ('currconns', (3,)), ('scur', (2,)), ('sent', (8,))]
+
+
+def test_module_blocks_share_snapshots_of_a_socket():
+    submitted = []
+    haproxy.submit_metrics = MagicMock(side_effect=lambda entry: submitted.append(
+        (entry.get('plugin_instance'), entry['type_instance'])))
+    sockets = []
+    module_configs = []
+    for proxy_monitor in ('frontend', 'backend'):
+        mock_config = Mock()
+        mock_config.children = [
+            ConfigOption('Socket', ('/var/run/haproxy-shared.sock',)),
+            ConfigOption('ProxyMonitor', (proxy_monitor,)),
+            ConfigOption('SharedSnapshotTTL', ('5',)),
+            ConfigOption('Testing', ('True',))
+        ]
+        module_config = haproxy.config(mock_config)
+        haproxy_socket = haproxy.HAProxySocket('/var/run/haproxy-shared.sock')
+        haproxy_socket.connect = MagicMock(side_effect=lambda: FakeSocket({
+            'show info': 'CurrConns: 3\n',
+            'show stat': '# pxname,svname,scur,type,\nweb,FRONTEND,1,0,\nweb,BACKEND,2,1,\n',
+            'show resolvers': ''}))
+        module_config['haproxy_sockets'] = {'/var/run/haproxy-shared.sock': haproxy_socket}
+        sockets.append(haproxy_socket)
+        module_configs.append(module_config)
+
+    for module_config in module_configs:
+        haproxy.collect_metrics(module_config)
+    assert sockets[0].connect.call_count == 3
+    assert not sockets[1].connect.called
+    assert submitted == [(None, 'currconns'), ('frontend.web', 'scur'), (None, 'currconns'), ('backend.web', 'scur')]
+
+
+def test_shared_snapshots_read_typed_stats_whole():
+    submitted = []
+    haproxy.submit_metrics = MagicMock(side_effect=lambda entry: submitted.append(
+        (entry.get('plugin_instance'), entry['type_instance'])))
+    mock_config = Mock()
+    mock_config.children = [
+        ConfigOption('Socket', ('/var/run/haproxy-typed.sock',)),
+        ConfigOption('ProxyMonitor', ('backend',)),
+        ConfigOption('SharedSnapshotTTL', ('5',)),
+        ConfigOption('TypedOutput', ('True',)),
+        ConfigOption('Testing', ('True',))
+    ]
+    module_config = haproxy.config(mock_config)
+    # enough rows for the typed response to span many reads
+    stat = ''.join('S.3.%d.0.pxname.1:KNSV:str:web\nS.3.%d.1.svname.1:KNSV:str:srv%d\nS.3.%d.4.scur.1:MGP:u32:1\n'
+                   % (sid, sid, sid, sid) for sid in range(1, 3001))
+    haproxy_socket = haproxy.HAProxySocket('/var/run/haproxy-typed.sock', typed=True)
+    haproxy_socket.connect = MagicMock(side_effect=lambda: FakeSocket({
+        'show info typed': '33.CurrConns.1:CGP:u32:3\n',
+        'show stat typed': stat,
+        'show resolvers': 'Resolvers section dns\n nameserver ns1:\n  sent: 8\n'}))
+    module_config['haproxy_sockets'] = {'/var/run/haproxy-typed.sock': haproxy_socket}
+    haproxy.collect_metrics(module_config)
+    assert len([key for key in submitted if key[1] == 'scur']) == 3000
+    assert ('nameserver.ns1', 'sent') in submitted
+
+
+def test_self_metrics_report_the_work_of_a_collection():
+    submitted = []
+    haproxy.submit_metrics = MagicMock(side_effect=lambda entry: submitted.append(
+        (entry.get('plugin_instance'), entry['type_instance'], entry['values'][0])))
+    mock_config = Mock()
+    mock_config.children = [
+        ConfigOption('ProxyMonitor', ('web',)),
+        ConfigOption('SelfMetrics', ('True',)),
+        ConfigOption('Testing', ('True',))
+    ]
+    module_config = haproxy.config(mock_config)
+    haproxy_socket = haproxy.HAProxySocket('/var/run/haproxy.sock')
+    responses = {
+        'show info': 'CurrConns: 3\n',
+        'show stat': '# pxname,svname,scur,type,\nweb,FRONTEND,1,0,\napi,FRONTEND,2,0,\n',
+        'show resolvers': ''}
+    haproxy_socket.connect = MagicMock(side_effect=lambda: FakeSocket(responses))
+    module_config['haproxy_sockets'] = {'/var/run/haproxy.sock': haproxy_socket}
+    haproxy.collect_metrics(module_config)
+
+    self_metrics = dict((name, value) for plugin_instance, name, value in submitted if plugin_instance == 'collector')
+    assert sorted(self_metrics) == sorted(haproxy.SELF_METRICS + ('rtt_info', 'rtt_resolvers', 'rtt_stat'))
+    assert self_metrics['io_time'] >= self_metrics['rtt_stat'] >= 0
+    assert self_metrics['requests'] == 3
+    # each response ends with an empty line
+    assert self_metrics['bytes_received'] == sum(len(response) + 1 for response in responses.values())
+    assert (self_metrics['rows_seen'], self_metrics['rows_filtered']) == (2, 1)
+    assert self_metrics['values_dispatched'] == 2
+    assert self_metrics['errors'] == 0
+    assert self_metrics['collect_time'] >= self_metrics['parse_time'] >= 0
+
+
+def test_commands_are_named_for_their_round_trip_times():
+    assert haproxy._get_command_name('show stat -1 6 -1 typed\n') == 'stat'
+    assert haproxy._get_command_name('@!1234 show info\n') == 'info'
+    assert haproxy._get_command_name('prompt\n') == 'prompt'
+    assert haproxy._get_command_name('show info;show stat;show resolvers\n') == 'batch'
+    assert haproxy._get_command_name('show info\nshow stat\n') == 'batch'
+
+
+def test_captured_responses_are_replayed():
+    directory = tempfile.mkdtemp()
+    try:
+        capture_file = os.path.join(directory, 'haproxy.cap')
+        capture = haproxy.CaptureWriter(capture_file)
+        recorded = haproxy.HAProxySocket('/var/run/haproxy.sock', capture=capture)
+        recorded._connect = MagicMock(side_effect=lambda: FakeSocket({
+            'show info': 'CurrConns: 3\n',
+            'show stat': '# pxname,svname,scur,type,\nweb,FRONTEND,1,0,\n'}))
+        expected = (recorded.get_server_info(), list(recorded.get_server_stats()), recorded.get_resolvers())
+        capture.close()
+
+        for use_mmap in (False, True):
+            replayed = haproxy.HAProxySocket('/var/run/haproxy.sock', replay=haproxy.CaptureReplay(capture_file,
+                                                                                                   use_mmap))
+            for _ in range(2):
+                stats = (replayed.get_server_info(), list(replayed.get_server_stats()), replayed.get_resolvers())
+                assert stats[0] == expected[0] and stats[2] == expected[2]
+                assert [dict(row.items()) for row in stats[1]] == [dict(row.items()) for row in expected[1]]
+                assert stats[1][0]['pxname'] == 'web'
+    finally:
+        shutil.rmtree(directory)
+
+
+@patch('haproxy.time.time')
+def test_circuit_breaker_backs_off_unreachable_sockets(mock_time):
+    mock_time.return_value = 1000.0
+    haproxy.submit_metrics = MagicMock()
+    mock_config = Mock()
+    mock_config.children = [
+        ConfigOption('CircuitBreaker', ('True',)),
+        ConfigOption('Interval', ('10',)),
+        ConfigOption('MaxBackoff', ('30',)),
+        ConfigOption('Testing', ('True',))
+    ]
+    module_config = haproxy.config(mock_config)
+    haproxy_socket = haproxy.HAProxySocket('/var/run/haproxy.sock')
+    haproxy_socket.connect = MagicMock(side_effect=socket.error('Connection refused'))
+    module_config['haproxy_sockets'] = {'/var/run/haproxy.sock': haproxy_socket}
+
+    warnings = []
+
+    def collect(at):
+        mock_time.return_value = at
+        haproxy.submit_metrics.reset_mock()
+        with patch.object(haproxy.collectd, 'warning', side_effect=warnings.append):
+            haproxy.collect_metrics(module_config)
+        up = [c[0][0]['values'] for c in haproxy.submit_metrics.call_args_list if c[0][0]['type_instance'] == 'up']
+        return haproxy_socket.connect.call_count, up
+
+    assert collect(1000.0) == (1, [(0,)])
+    # backs off for 5 to 10 seconds, then 10 to 20, then at most 30
+    assert collect(1004.0) == (1, [(0,)])
+    assert collect(1010.0) == (2, [(0,)])
+    assert collect(1014.0) == (2, [(0,)])
+    assert collect(1031.0) == (3, [(0,)])
+    breaker = module_config['circuit_breakers']['/var/run/haproxy.sock']
+    assert 15 <= breaker.retry_at - 1031.0 <= 30
+    # only going unreachable is logged, not every interval without data
+    assert warnings == ['status err Unable to connect to HAProxy socket at /var/run/haproxy.sock (Connection refused), '
+                        'backing off for up to 30.0s']
+
+    # nor, with BackgroundPolling, the snapshot going stale while the poller backs off
+    polled_config = background_config(ConfigOption('CircuitBreaker', ('True',)))
+    polled_config['poller'].start = MagicMock()
+    polled_config['poller'].latest = (1031.0 - 60, (('CumReq', 5, {}),))
+    polled_config['circuit_breakers']['/var/run/haproxy.sock'] = breaker
+    with patch.object(haproxy.collectd, 'warning', side_effect=warnings.append):
+        haproxy.collect_metrics(polled_config)
+    assert len(warnings) == 1
+
+    haproxy_socket.connect = MagicMock(side_effect=lambda: FakeSocket({'show info': 'CurrConns: 3\n'}))
+    assert collect(1061.0) == (3, [(1,)])
+    assert breaker.state == 'closed' and breaker.failures == 0
+    # a snapshot going stale with the socket reachable is still logged
+    with patch.object(haproxy.collectd, 'warning', side_effect=warnings.append):
+        haproxy.collect_metrics(polled_config)
+    assert warnings[1:] == ['haproxy: Latest snapshot of HAProxy socket at /var/run/haproxy.sock is stale, taken '
+                            '90.0s ago', 'haproxy: No data received']
+
+
+def test_grouped_metrics_are_dispatched_as_data_sets():
+    submitted = []
+    haproxy.submit_metrics = MagicMock(side_effect=lambda entry: submitted.append(
+        (entry.get('plugin_instance'), entry['type'], entry['type_instance'], entry['values'])))
+    mock_config = Mock()
+    mock_config.children = [
+        ConfigOption('ProxyMonitor', ('backend',)),
+        ConfigOption('GroupMetrics', ('True',)),
+        ConfigOption('Testing', ('True',))
+    ]
+    module_config = haproxy.config(mock_config)
+    haproxy_socket = haproxy.HAProxySocket('/var/run/haproxy.sock')
+    haproxy_socket.connect = MagicMock(side_effect=lambda: FakeSocket({
+        'show stat -1 6 -1': '# pxname,svname,bin,bout,scur,smax,qcur,type,\nweb,BACKEND,10,20,1,5,3,1,\n'}))
+    module_config['haproxy_sockets'] = {'/var/run/haproxy.sock': haproxy_socket}
+    haproxy.collect_metrics(module_config)
+    # qmax wasn't reported, so qcur goes on its own
+    assert sorted(submitted) == [('backend.web', 'gauge', 'qcur', (3,)),
+                                 ('backend.web', 'haproxy_bytes', '', (10, 20)),
+                                 ('backend.web', 'haproxy_sessions', '', (1, 5))]
+
+
+def test_types_db_matches_grouped_metrics():
+    data_sets = {}
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'haproxy_types.db')) as types_db:
+        for line in types_db:
+            if line.strip() and not line.startswith('#'):
+                name, sources = line.split(None, 1)
+                data_sets[name] = [source.strip().split(':') for source in sources.split(',')]
+    assert sorted(data_sets) == sorted(haproxy.GROUPED_METRICS)
+    for name, metric_names in haproxy.GROUPED_METRICS.items():
+        assert [source[0] for source in data_sets[name]] == list(metric_names)
+        assert [source[1].lower() for source in data_sets[name]] == [haproxy.METRICS_TO_COLLECT[metric_name]
+                                                                    for metric_name in metric_names]
+
+
+def test_stick_table_entries_are_aggregated_while_streamed():
+    submitted = []
+    haproxy.submit_metrics = MagicMock(side_effect=lambda entry: submitted.append(
+        (entry.get('plugin_instance'), entry['type_instance'], entry['values'][0])))
+    mock_config = Mock()
+    mock_config.children = [
+        ConfigOption('ProxyMonitor', ('backend',)),
+        ConfigOption('StickTableEntries', ('front_*',)),
+        ConfigOption('StickTableTopN', ('2',)),
+        ConfigOption('Testing', ('True',))
+    ]
+    module_config = haproxy.config(mock_config)
+    entries = ''.join('0x55d7c4cbd%03x: key=10.0.0.%d use=0 exp=299934 gpc0=%d conn_rate(30000)=%d server_id=1\n'
+                      % (i, i, i % 2, i) for i in range(1, 101))
+    haproxy_socket = haproxy.HAProxySocket('/var/run/haproxy.sock')
+    haproxy_socket.connect = MagicMock(side_effect=lambda: FakeSocket({
+        'show table': '# table: front_pub, type: ip, size:204800, used:100\n'
+                      '# table: back_rdp, type: ip, size:1024, used:0\n',
+        'show table front_pub': '# table: front_pub, type: ip, size:204800, used:100\n' + entries}))
+    haproxy_socket._buffer.recv_size = 64
+    module_config['haproxy_sockets'] = {'/var/run/haproxy.sock': haproxy_socket}
+    haproxy.collect_metrics(module_config)
+
+    table_stats = [stat for stat in submitted if stat[0] is not None and stat[0].startswith('table.')]
+    assert table_stats == [
+        ('table.front_pub', 'size', 204800), ('table.front_pub', 'used', 100), ('table.front_pub', 'entries', 100),
+        ('table.front_pub', 'gpc0_sum', 50), ('table.front_pub', 'gpc0_max', 1), ('table.front_pub', 'gpc0_p50', 0),
+        ('table.front_pub', 'gpc0_p95', 1), ('table.front_pub', 'gpc0_p99', 1),
+        # ties keep the keys seen first
+        ('table.front_pub', 'gpc0_top.10.0.0.3', 1), ('table.front_pub', 'gpc0_top.10.0.0.1', 1),
+        ('table.front_pub', 'conn_rate_sum', 5050), ('table.front_pub', 'conn_rate_max', 100),
+        ('table.front_pub', 'conn_rate_p50', 50), ('table.front_pub', 'conn_rate_p95', 95),
+        ('table.front_pub', 'conn_rate_p99', 99), ('table.front_pub', 'conn_rate_top.10.0.0.100', 100),
+        ('table.front_pub', 'conn_rate_top.10.0.0.99', 99),
+        ('table.back_rdp', 'size', 1024), ('table.back_rdp', 'used', 0)]
+
+
+def test_stick_table_keys_are_parsed_whole_and_made_safe():
+    assert haproxy._parse_table_entry('0x55d7c4cbd5e0: key=Mozilla/5.0 (X11; Linux) use=0 exp=0 http_req_rate(10000)=3'
+                                      ) == ('Mozilla/5.0 (X11; Linux)', [('http_req_rate', 3)])
+    assert haproxy._parse_table_entry('0x55d7c4cbd5e0: key=10.0.0.1 use=0 exp=0 gpc0=2') == ('10.0.0.1', [('gpc0', 2)])
+    aggregator = haproxy.TableAggregator(3)
+    long_key = '/api/v1/users/' + 'x' * 60
+    for key, value in (('/api/v1/users', 3), ('Mozilla/5.0 (X11; Linux)', 2), (long_key, 1)):
+        aggregator.add(key, [('http_req_rate', value)])
+    top = [name for name, _ in aggregator.iter_stats() if '_top.' in name]
+    assert top[:2] == ['http_req_rate_top._api_v1_users', 'http_req_rate_top.Mozilla_5.0__X11__Linux_']
+    assert len(top[2]) == len('http_req_rate_top.') + haproxy.TABLE_KEY_MAX_LENGTH
+    assert top[2].startswith('http_req_rate_top._api_v1_users_xxx')
+
+
+INTERNALS_RESPONSES = {
+    'show activity': 'thread_id: 1 (1..2)\ndate_now: 1594046406.785155\nloops: 300 [ 100 200 ]\n'
+                     'poll_io: 7 [ 3 4 ]\navg_loop_us: 36 [ 33 39 ]\nunknown_counter: 1 [ 1 0 ]\n',
+    'show pools': 'Dumping pools usage. Use SIGQUIT to flush them.\n'
+                  '  - Pool pipe (16 bytes) : 5 allocated (80 bytes), 4 used, needed_avg 0, 12 failures, 2 users, '
+                  '@0x9508e0=02 [SHARED]\n'
+                  '  - Pool buffer (16384 bytes) : 3 allocated (49152 bytes), 1 used, 0 failures, 1 users [SHARED]\n'
+                  'Total: 2 pools, 49232 bytes allocated, 16448 used.\n',
+    'show tasks': 'Running tasks: 5 (2 threads)\n  function                     places     %    lat_tot   lat_avg\n'
+                  '  process_stream                    3   60.0      -         -\n'
+                  '  h1_io_cb                          2   40.0      -         -\n',
+    'show sess': '0x55d7c4cbd5e0: proto=tcpv4 src=10.0.0.1:5360 fe=http-in be=web srv=web1 ts=00 age=3s calls=2\n'
+                 '0x55d7c4cbd6e0: proto=tcpv4 src=10.0.0.2:5361 fe=http-in be=web srv=web2 ts=00 age=1s calls=1\n'
+                 '0x55d7c4cbd7e0: proto=unix_stream src=unix:1 fe=GLOBAL be=<NONE> srv=<none> ts=00 age=0s calls=1\n',
+}
+
+
+def test_internals_are_collected_when_enabled():
+    submitted = []
+    haproxy.submit_metrics = MagicMock(side_effect=lambda entry: submitted.append(
+        (entry.get('plugin_instance'), entry['type'], entry['type_instance'], entry['values'][0])))
+    mock_config = Mock()
+    mock_config.children = [
+        ConfigOption('ProxyMonitor', ('backend',)),
+        ConfigOption('ActivityMetrics', ('True',)),
+        ConfigOption('PoolMetrics', ('True',)),
+        ConfigOption('TaskMetrics', ('True',)),
+        ConfigOption('SessionMetrics', ('True',)),
+        ConfigOption('Testing', ('True',))
+    ]
+    module_config = haproxy.config(mock_config)
+    haproxy_socket = haproxy.HAProxySocket('/var/run/haproxy.sock')
+    haproxy_socket.connect = MagicMock(side_effect=lambda: FakeSocket(INTERNALS_RESPONSES))
+    module_config['haproxy_sockets'] = {'/var/run/haproxy.sock': haproxy_socket}
+    haproxy.collect_metrics(module_config)
+
+    assert submitted == [
+        ('activity', 'derive', 'loops', 300), ('activity.thread.1', 'derive', 'loops', 100),
+        ('activity.thread.2', 'derive', 'loops', 200), ('activity', 'derive', 'poll_io', 7),
+        ('activity.thread.1', 'derive', 'poll_io', 3), ('activity.thread.2', 'derive', 'poll_io', 4),
+        ('activity', 'gauge', 'avg_loop_us', 36), ('activity.thread.1', 'gauge', 'avg_loop_us', 33),
+        ('activity.thread.2', 'gauge', 'avg_loop_us', 39),
+        ('pool.pipe', 'gauge', 'allocated', 5), ('pool.pipe', 'gauge', 'allocated_bytes', 80),
+        ('pool.pipe', 'gauge', 'used', 4), ('pool.pipe', 'gauge', 'used_bytes', 64),
+        ('pool.pipe', 'derive', 'failures', 12),
+        ('pool.buffer', 'gauge', 'allocated', 3), ('pool.buffer', 'gauge', 'allocated_bytes', 49152),
+        ('pool.buffer', 'gauge', 'used', 1), ('pool.buffer', 'gauge', 'used_bytes', 16384),
+        ('pool.buffer', 'derive', 'failures', 0),
+        ('pool', 'gauge', 'allocated_bytes', 49232), ('pool', 'gauge', 'used_bytes', 16448),
+        ('tasks', 'gauge', 'running', 5), ('tasks.process_stream', 'gauge', 'places', 3),
+        ('tasks.h1_io_cb', 'gauge', 'places', 2), ('sessions', 'gauge', 'sessions', 3)] + sorted([
+            ('sessions.GLOBAL', 'gauge', 'sessions', 1), ('sessions.http-in', 'gauge', 'sessions', 2)])
+
+
+def test_activity_of_haproxy_1_9_has_no_totals_of_gauges():
+    activity = haproxy._parse_activity('loops: 100 200\navg_loop_us: 33 39\n')
+    assert activity == {'loops': (300, [100, 200]), 'avg_loop_us': (None, [33, 39])}